@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 import json
+import time
 from pprint import pprint, pformat
 import logging
 import requests
@@ -10,9 +11,21 @@ from vaccine_finder.config import (
     DEFAULT_PHONE_NUM,
     DEFAULT_ZIP_CODES,
     DEFAULT_RADIUS,
+    NOTIFY_ASYNC,
+    INPUT_SOURCE,
 )
-from vaccine_finder.utils import setup_logger, send_request
+from vaccine_finder.utils import setup_logger, send_request, LazyFormat
 from vaccine_finder.notify import Notifier
+from vaccine_finder.metrics import (
+    incr_metric, observe_metric, flush_metrics,
+)
+from vaccine_finder.state import AvailabilityState
+from vaccine_finder.geo import ZipGeocoder
+from vaccine_finder.subscribers import (
+    SubscriberIndex, parse_subscribers, locate_subscribers,
+)
+from vaccine_finder.inputs import get_input_store
+from vaccine_finder.regions import DEFAULT_REGION
 
 
 class BaseAppointmentFinder(ABC):
@@ -23,6 +36,7 @@ class BaseAppointmentFinder(ABC):
         debug=False,
         input_file=DEFAULT_INPUT_FILE,
         cookie_dict=None,
+        region=DEFAULT_REGION,
     ):
         setup_logger()
         self.logger = logging.getLogger(type(self).__name__)
@@ -30,9 +44,11 @@ class BaseAppointmentFinder(ABC):
         self.scheduler_endpoint = scheduler_endpoint
         self.debug = debug
         self.input_file = input_file
+        self.region = region
 
         self.logger.info(f"Initializing {type(self).__name__} ...")
         self.logger.info(f"DEBUG: {self.debug}")
+        self.logger.info(f"REGION: {self.region}")
         self.logger.info(f"INPUTS: {self.input_file}")
 
         # Create session with cookie
@@ -46,39 +62,146 @@ class BaseAppointmentFinder(ABC):
         self.zip_codes = DEFAULT_ZIP_CODES
         self.radius = DEFAULT_RADIUS
         self.subscribers = dict()
-        if os.path.exists(self.input_file):
-            with open(self.input_file) as json_file:
-                inputs = json.load(json_file)
-                self.zip_codes = inputs["location"]["zip_codes"]
-                self.radius = inputs["location"]["radius"]
-                self.subscribers = inputs["subscribers"]
-                if self.debug:
-                    self.subscribers = {
-                        DEFAULT_PHONE_NUM: self.subscribers.get(
-                            DEFAULT_PHONE_NUM
-                        )
-                    }
-        else:
-            self.logger.warning(
-                f"⚠️  Input file {self.input_file} not found"
-            )
+        # Location entries of the subscribers that have one, by phone number
+        self.subscriber_locations = dict()
+        self._subscriber_index = None
+        self._inputs_mtime = None
+        self._inputs_version = None
+        # Inputs shared by every finder of the process, instead of the file
+        self.input_store = (
+            get_input_store(region) if INPUT_SOURCE == "redis" else None
+        )
+        self.geocoder = ZipGeocoder()
+        if not self.reload_inputs():
+            if self.input_store is not None:
+                self.logger.warning("⚠️  No inputs imported into Redis")
+            else:
+                self.logger.warning(
+                    f"⚠️  Input file {self.input_file} not found"
+                )
 
         self.notifier = Notifier()
+        # Regions are notified independently of each other
+        self.availability_state = AvailabilityState(
+            type(self).__name__ if region == DEFAULT_REGION
+            else f"{type(self).__name__}:{region}"
+        )
+        # Outcome of the last find run
+        self.last_keys = set()
+        self.last_error = None
+
+    def reload_inputs(self):
+        """
+        Read inputs from the input file, or the input store, if they
+        changed since the last read. Return False if there are none
+        """
+        if self.input_store is not None:
+            return self._reload_from_store()
+        try:
+            mtime = os.stat(self.input_file).st_mtime
+        except OSError:
+            return False
+        if mtime == self._inputs_mtime:
+            return True
+
+        with open(self.input_file) as json_file:
+            inputs = json.load(json_file)
+            self._set_inputs(
+                inputs["location"]["zip_codes"],
+                inputs["location"]["radius"],
+                *parse_subscribers(inputs["subscribers"])
+            )
+        if self._inputs_mtime is not None:
+            self.logger.info(f"Reloaded inputs from {self.input_file}")
+        self._inputs_mtime = mtime
+        return True
+
+    def _reload_from_store(self):
+        """
+        Pick up the input store's changes. The store's dicts are shared
+        by every finder of the process rather than copied
+        """
+        version = self.input_store.refresh()
+        if not version:
+            return False
+        if version == self._inputs_version:
+            return True
+        store = self.input_store
+        self._set_inputs(
+            store.zip_codes, store.radius, store.subscribers,
+            store.subscriber_locations,
+        )
+        if self._inputs_version is not None:
+            self.logger.info(f"Reloaded inputs, version {version}")
+        self._inputs_version = version
+        return True
+
+    def _set_inputs(self, zip_codes, radius, subscribers, locations):
+        self.zip_codes = zip_codes
+        self.radius = radius
+        self.subscribers = subscribers
+        self.subscriber_locations = locations
+        if self.debug:
+            self.subscribers = {
+                DEFAULT_PHONE_NUM: subscribers.get(DEFAULT_PHONE_NUM)
+            }
+        self._subscriber_index = None
+
+    @property
+    def subscriber_index(self):
+        """
+        Spatial index of the subscribers with a location, built on first
+        use after the inputs are (re)loaded
+        """
+        if self._subscriber_index is None:
+            subscribers = locate_subscribers(
+                {
+                    ph: entry
+                    for ph, entry in self.subscriber_locations.items()
+                    if ph in self.subscribers
+                },
+                self.geocoder, self.radius,
+            )
+            self._subscriber_index = SubscriberIndex(subscribers)
+            self.logger.info(
+                f"Indexed {len(subscribers)} subscribers with a location"
+            )
+        return self._subscriber_index
 
     def find(self, *args, **kwargs):
         """
         See _find
+
+        Records the run's duration by finder, region and outcome. A
+        sweep_error, from a shared sweep of several regions, fails the run
         """
+        start = time.monotonic()
         success = True
+        self.last_keys = set()
+        self.last_error = None
         try:
             notify = kwargs.pop('notify', False)
             self.logger.info(f"NOTIFY: {notify}")
+            sweep_error = kwargs.pop("sweep_error", None)
+            if sweep_error is not None:
+                raise sweep_error
             success = self._find(*args, **kwargs)
+            keys = self._availability_keys() if success else set()
+            if not self.debug:
+                # What couldn't be checked isn't closed, keep its state
+                keys = self.availability_state.carry_forward(
+                    keys, self._unchecked_keys()
+                )
+            self.last_keys = keys
             if success:
-                self.notify(send_notifications=notify)
+                self._notify_openings(keys, send_notifications=notify)
+            elif not self.debug:
+                # Forget closed openings so they're new when they reopen
+                self.availability_state.openings(keys)
 
         except Exception as e:
             success = False
+            self.last_error = repr(e)
             self.logger.error("Something went wrong in vaccine finder!")
             self.logger.exception(str(e))
 
@@ -87,31 +210,151 @@ class BaseAppointmentFinder(ABC):
         else:
             self.logger.info("🚫 No stores have appointments!")
 
+        if self.last_error:
+            outcome = "error"
+        else:
+            outcome = "available" if success else "unavailable"
+        observe_metric(
+            "finder_run_seconds",
+            {
+                "finder": type(self).__name__, "region": self.region,
+                "outcome": outcome,
+            },
+            time.monotonic() - start
+        )
+        flush_metrics()
         return success
 
-    def notify(self, send_notifications=False):
+    @classmethod
+    def sweep_regions(cls, finders, notify=False):
+        """
+        Run this chain's finders of several regions, checking what they
+        have in common once (see _sweep_shared), and notify each region.
+        Return whether each found appointments
+        """
+        if len(finders) == 1:
+            return [finders[0].find(notify=notify)]
+        try:
+            shared = cls._sweep_shared(finders)
+        except Exception as e:
+            shared = [{"sweep_error": e}] * len(finders)
+        return [
+            finder.find(notify=notify, **kwargs)
+            for finder, kwargs in zip(finders, shared)
+        ]
+
+    @classmethod
+    def _sweep_shared(cls, finders):
+        """
+        Check the union of what the finders' regions need once and return
+        each finder's _find kwargs with its share of the results. By
+        default each finder checks on its own
+        """
+        return [{} for finder in finders]
+
+    def _notify_openings(self, keys, send_notifications=False):
+        """
+        Notify users only if something opened up since the last notification
+        """
+        if self.debug:
+            openings = keys
+        else:
+            openings = self.availability_state.openings(keys)
+        if not openings:
+            self.logger.info("No new openings since the last notification")
+            return
+
+        self.logger.info(f"{len(openings)} new openings")
+        self.notify(send_notifications=send_notifications, openings=openings)
+        if send_notifications and not self.debug:
+            self.availability_state.mark_notified(openings)
+
+    def notify(self, send_notifications=False, openings=None):
         """
         Notify users (text, email) that appointments are available in stores
+
+        If the finder knows where the appointments are, subscribers with a
+        location are only texted about the stores in their range, nearest
+        first, and only if one of them is among the openings (availability
+        keys) given. Subscribers without a location get every store
         """
         self.logger.info("Notifying users of open appointments ...")
+        output = self._compose_message(self._notification_message())
+        if send_notifications:
+            labels = {"finder": type(self).__name__, "region": self.region}
+            incr_metric("finder_notifications", labels)
+            groups = self._targeted_texts(output, openings)
+            notified = sum(len(phs) for phs in groups.values())
+            incr_metric("finder_notified_subscribers", labels, notified)
+            incr_metric(
+                "finder_out_of_range_subscribers", labels,
+                len(self.subscribers) - notified
+            )
+            for message, phone_numbers in groups.items():
+                if NOTIFY_ASYNC:
+                    self.notifier.enqueue_texts(message, phone_numbers)
+                else:
+                    self.notifier.send_texts(message, phone_numbers)
+            self.logger.info(
+                f"{'Queued' if NOTIFY_ASYNC else 'Sent'} texts to "
+                f"{notified} of {len(self.subscribers)} subscribers in "
+                f"{len(groups)} notifications"
+            )
+            self.logger.debug(
+                "Subscribers: %s", LazyFormat(pformat, groups)
+            )
+        self.logger.info(output)
+
+    def _compose_message(self, custom_message):
         messages = [
             "--------------------",
             f"🚑 {self.store_label} Stores Have Open Appointments!!!",
         ]
-        custom_message = self._notification_message()
         messages.append(custom_message)
         messages.append(f"➡ To register, go to {self.scheduler_endpoint}")
-        output = "\n\n".join(messages)
-        if send_notifications:
-            self.notifier.send_texts(
-                output, phone_numbers=[
-                    ph for ph, email in self.subscribers.items()
-                ]
-            )
-            self.logger.info(
-                f"Sent texts to subscribers: {pformat(self.subscribers)}"
+        return "\n\n".join(messages)
+
+    def _targeted_texts(self, output, openings=None):
+        """
+        Return the phone numbers to text by message
+        """
+        locations = self._opening_locations()
+        if locations is None:
+            return {output: list(self.subscribers)}
+
+        index = self.subscriber_index
+        matches = index.match(locations)
+        groups = {}
+        everywhere = [
+            ph for ph in self.subscribers if ph not in index.phone_numbers
+        ]
+        if everywhere:
+            groups[output] = everywhere
+        for phone_number, matched in matches.items():
+            if openings is not None and not any(
+                loc.key in openings for loc in matched
+            ):
+                continue
+            message = self._compose_message(
+                "\n\n".join(loc.label for loc in matched)
             )
-        self.logger.info(output)
+            groups.setdefault(message, []).append(phone_number)
+        return groups
+
+    def _opening_locations(self):
+        """
+        Return a list of subscribers.OpeningLocation, where _find found
+        appointments, or None if the finder can't tell and every subscriber
+        is notified
+        """
+        return None
+
+    def _unchecked_keys(self):
+        """
+        Return the set of keys _find couldn't check, which keep their last
+        known availability
+        """
+        return set()
 
     @abstractmethod
     def _find(self, *args, **kwargs):
@@ -123,6 +366,16 @@ class BaseAppointmentFinder(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def _availability_keys(self):
+        """
+        Return the set of keys (store numbers, query points, pages) that
+        currently have appointments. Called after _find succeeds
+
+        MUST BE IMPLEMENTED BY SUBCLASSES
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def _notification_message(self):
         """
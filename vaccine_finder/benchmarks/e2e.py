@@ -0,0 +1,305 @@
+"""
+Time from a slot opening to its texts being delivered, through the whole
+pipeline: AdaptiveScheduler -> rq finder job -> find -> notification job
+-> Notifier -> Twilio, with the chain APIs and Twilio replaced by local
+stubs
+
+    python -m vaccine_finder.benchmarks.e2e --stores 2000 \\
+        --subscribers 20000 --workers 1 2 4 8
+
+Needs a Redis server at REDIS_HOST:REDIS_PORT. The harness uses, and
+flushes, database --redis-db. Workers are separate processes running rq
+SimpleWorkers on the notification and finder queues
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from redis import Redis
+from rq import Queue
+from rq.worker import SimpleWorker
+from twilio.rest import Client
+
+from vaccine_finder import registry, utils
+from vaccine_finder.benchmarks.finders import percentile
+from vaccine_finder.benchmarks.stubs import (
+    ChainData, StubChainServer, StubTwilioServer, route_to_stub,
+)
+from vaccine_finder.config import REDIS_HOST, REDIS_PORT, NOTIFY_QUEUE
+from vaccine_finder.jobs import _find_result
+from vaccine_finder.notify import Notifier, RedirectingHttpClient
+from vaccine_finder.registry import FINDERS, get_finder
+from vaccine_finder.regions import DEFAULT_REGION
+from vaccine_finder.scheduler import AdaptiveScheduler
+from vaccine_finder.riteaid import finder as riteaid
+from vaccine_finder.walgreens import finder as walgreens
+from vaccine_finder.wegmans import finder as wegmans
+from vaccine_finder.allentown import finder as allentown
+
+FINDER_QUEUE = "default"
+STORE_LABELS = {
+    "riteaid": riteaid.STORE_LABEL,
+    "walgreens": walgreens.STORE_LABEL,
+    "wegmans": wegmans.STORE_LABEL,
+    "allentown": allentown.STORE_LABEL,
+}
+
+
+def _harness_job(name):
+    """
+    Finder job that runs at any time of day and always texts subscribers
+    """
+    finder = get_finder(name)
+    return _find_result(finder, finder.find(notify=True))
+
+
+def riteaid_job():
+    return _harness_job("riteaid")
+
+
+def walgreens_job():
+    return _harness_job("walgreens")
+
+
+def wegmans_job():
+    return _harness_job("wegmans")
+
+
+def allentown_job():
+    return _harness_job("allentown")
+
+
+JOBS = {
+    "riteaid": riteaid_job,
+    "walgreens": walgreens_job,
+    "wegmans": wegmans_job,
+    "allentown": allentown_job,
+}
+
+
+class Opening(object):
+    """
+    Opens and closes appointments of one chain in the stub's data
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.marker = None
+
+    def open(self):
+        with self.data.lock:
+            if self.name == "riteaid":
+                store = random.choice(self.data.stores)
+                self.data.open_stores.add(store["storeNumber"])
+                self.marker = f"Store #{store['storeNumber']} "
+            else:
+                if self.name == "walgreens":
+                    self.data.walgreens_open = True
+                else:
+                    self.data.open_pages.add(self.name)
+                self.marker = f"{STORE_LABELS[self.name]} Stores"
+
+    def close(self):
+        with self.data.lock:
+            self.data.open_stores.clear()
+            self.data.walgreens_open = False
+            self.data.open_pages.discard(self.name)
+
+
+def run_worker(redis_db, names, chain_url, twilio_url, input_file, rate):
+    """
+    rq worker process whose finders and notifier talk to the stubs
+    """
+    logging.disable(logging.CRITICAL)
+    connection = Redis(host=REDIS_HOST, port=REDIS_PORT, db=redis_db)
+    utils._redis_connection = connection
+    for name in names:
+        finder = route_to_stub(
+            FINDERS[name](input_file=input_file), chain_url
+        )
+        # Every opening in the run is new, don't hold any back
+        finder.availability_state.cooldown = 0
+        registry._finders[(name, DEFAULT_REGION)] = finder
+    registry._notifier = Notifier(
+        client=Client(
+            "ACstub", "token", http_client=RedirectingHttpClient(twilio_url)
+        ),
+        rate_limit=rate,
+    )
+    SimpleWorker(
+        [NOTIFY_QUEUE, FINDER_QUEUE], connection=connection
+    ).work(with_scheduler=False)
+
+
+def write_inputs(subscribers):
+    inputs = {
+        "subscribers": {
+            f"+1555{i:07d}": f"subscriber{i}@example.com"
+            for i in range(subscribers)
+        },
+        "location": {"zip_codes": [19403], "radius": 50},
+    }
+    fd, path = tempfile.mkstemp(prefix="e2e_inputs_", suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(inputs, f)
+    return path
+
+
+def run_scheduler(scheduler, stop, tick=0.2):
+    while not stop.is_set():
+        scheduler.tick()
+        stop.wait(tick)
+
+
+def wait_for_texts(twilio, marker, since, expected, timeout):
+    """
+    Return receive times of the texts containing marker sent after since,
+    once expected of them arrived or timeout passed
+    """
+    deadline = time.time() + timeout
+    while True:
+        with twilio.lock:
+            times = [
+                m["received_at"] for m in twilio.messages
+                if m["received_at"] >= since and marker in (m["body"] or "")
+            ]
+        if len(times) >= expected or time.time() > deadline:
+            return times
+        time.sleep(0.05)
+
+
+def run_once(workers, args, chain, twilio, data, input_file):
+    """
+    Run the pipeline with the number of workers and return text latencies
+    """
+    connection = Redis(host=REDIS_HOST, port=REDIS_PORT, db=args.redis_db)
+    connection.flushdb()
+    utils._redis_connection = connection
+    with twilio.lock:
+        twilio.messages.clear()
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=run_worker, daemon=True,
+            args=(args.redis_db, args.finders, chain.base_url,
+                  twilio.base_url, input_file, args.rate),
+        )
+        for _ in range(workers)
+    ]
+    for p in processes:
+        p.start()
+
+    scheduler = AdaptiveScheduler(
+        Queue(FINDER_QUEUE, connection=connection),
+        [JOBS[name] for name in args.finders],
+        window=(datetime.time.min, datetime.time.max),
+        base_interval=args.interval,
+        min_interval=args.interval,
+        jitter=0,
+    )
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=run_scheduler, args=(scheduler, stop), daemon=True
+    )
+    thread.start()
+
+    first, every = [], []
+    try:
+        # Wait for a closed baseline of every chain
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and any(
+            c.last_keys is None for c in scheduler.chains
+        ):
+            time.sleep(0.1)
+
+        for i in range(args.openings):
+            opening = Opening(args.finders[i % len(args.finders)], data)
+            # Openings land anywhere within a polling interval
+            time.sleep(random.uniform(0, args.interval))
+            opened_at = time.time()
+            opening.open()
+            times = wait_for_texts(
+                twilio, opening.marker, opened_at, args.subscribers,
+                args.timeout
+            )
+            opening.close()
+            if not times:
+                print(f"⚠️  No texts for {opening.name} opening {i}")
+                continue
+            latencies = sorted(t - opened_at for t in times)
+            first.append(latencies[0])
+            every.extend(latencies)
+            # Let the finder see the closing before the next opening
+            time.sleep(args.interval * 1.5)
+    finally:
+        stop.set()
+        thread.join()
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join(5)
+    return first, every
+
+
+def run(args):
+    data = ChainData(stores=args.stores, open_rate=0)
+    input_file = write_inputs(args.subscribers)
+    chain = StubChainServer(latency=args.latency, data=data)
+    twilio = StubTwilioServer(latency=args.latency)
+    print(
+        f"{args.stores} stores, {args.subscribers} subscribers, "
+        f"{args.openings} openings, polling every {args.interval} s"
+    )
+    print(
+        f"{'workers':>7} {'texts':>8} {'first p50':>10} {'p50 s':>8} "
+        f"{'p90 s':>8} {'p99 s':>8} {'max s':>8}"
+    )
+    try:
+        with chain, twilio:
+            for workers in args.workers:
+                first, every = run_once(
+                    workers, args, chain, twilio, data, input_file
+                )
+                if not every:
+                    print(f"{workers:>7} {'no texts delivered':>36}")
+                    continue
+                print(
+                    f"{workers:>7} {len(every):>8} "
+                    f"{percentile(first, 50):>10.2f} "
+                    f"{percentile(every, 50):>8.2f} "
+                    f"{percentile(every, 90):>8.2f} "
+                    f"{percentile(every, 99):>8.2f} {max(every):>8.2f}"
+                )
+    finally:
+        os.remove(input_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure slot opening to text delivery latency"
+    )
+    parser.add_argument("--finders", nargs="+", default=["riteaid"],
+                        choices=list(JOBS))
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--openings", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=5,
+                        help="Finder polling interval in seconds")
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="Texts per second per worker")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Stub API latency in seconds")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds to wait for an opening's texts")
+    parser.add_argument("--redis-db", type=int, default=15)
+    run(parser.parse_args())
@@ -0,0 +1,113 @@
+"""
+Runs per second, latency and peak memory of each finder's find against a
+local stand-in of the chain APIs
+
+    python -m vaccine_finder.benchmarks.finders --runs 20 --stores 500
+
+Use --cassettes DIR to replay responses recorded from the real sites (add
+--record to record the missing ones first), synthetic data otherwise
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.benchmarks.stubs import (
+    ChainData, StubChainServer, route_to_stub,
+)
+from vaccine_finder.registry import FINDERS
+from vaccine_finder.utils import get_redis_connection
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def benchmark_finder(name, base_url, runs):
+    """
+    Run the finder's find runs times and return its results. The
+    availability cache is off so every run sends its requests
+    """
+    finder = route_to_stub(FINDERS[name](), base_url)
+    if hasattr(finder, "availability_cache"):
+        finder.availability_cache.ttl = 0
+    latencies = []
+    successes = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(runs):
+        run_start = time.perf_counter()
+        successes += bool(finder.find(notify=False))
+        latencies.append(time.perf_counter() - run_start)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "runs_per_sec": runs / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak": peak,
+        "successes": successes,
+    }
+
+
+def redis_available():
+    try:
+        return bool(get_redis_connection().ping())
+    except RedisError:
+        return False
+
+
+def run(names, runs, latency, error_rate, stores, open_rate,
+        cassettes=None, record=False):
+    # Keep the finders' per run logging out of the timings
+    logging.disable(logging.CRITICAL)
+    data = ChainData(stores=stores, open_rate=open_rate)
+    stub = StubChainServer(
+        latency=latency, error_rate=error_rate, data=data,
+        cassettes=cassettes, record=record,
+    )
+    with stub:
+        print(f"Redis caches: {'on' if redis_available() else 'off'}")
+        print(
+            f"{'finder':<10} {'runs/s':>8} {'p50 ms':>9} {'p99 ms':>9} "
+            f"{'peak KiB':>9} {'open':>5} {'requests':>9}"
+        )
+        for name in names:
+            before = sum(stub.requests.values())
+            result = benchmark_finder(name, stub.base_url, runs)
+            requests_sent = sum(stub.requests.values()) - before
+            print(
+                f"{name:<10} {result['runs_per_sec']:>8.2f} "
+                f"{result['p50'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} "
+                f"{result['peak'] / 1024:>9.0f} {result['successes']:>5} "
+                f"{requests_sent:>9}"
+            )
+    logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the finders")
+    parser.add_argument("--finders", nargs="+", default=list(FINDERS),
+                        choices=list(FINDERS))
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Stub chain API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of stub API calls that fail with 503")
+    parser.add_argument("--stores", type=int, default=100,
+                        help="Number of synthetic RiteAid stores")
+    parser.add_argument("--open-rate", type=float, default=0.0,
+                        help="Fraction of synthetic stores with openings")
+    parser.add_argument("--cassettes", help="Recorded responses directory")
+    parser.add_argument("--record", action="store_true",
+                        help="Record responses missing from --cassettes")
+    args = parser.parse_args()
+    run(args.finders, args.runs, args.latency, args.error_rate, args.stores,
+        args.open_rate, cassettes=args.cassettes, record=args.record)
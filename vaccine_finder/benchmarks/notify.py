@@ -0,0 +1,56 @@
+"""
+End to end time to send N texts through the Notifier against a local
+stand-in of the Twilio API
+
+    python -m vaccine_finder.benchmarks.notify --messages 500 --rate 100
+"""
+import argparse
+import time
+
+from twilio.rest import Client
+
+from vaccine_finder.benchmarks.stubs import StubTwilioServer
+from vaccine_finder.notify import Notifier, RedirectingHttpClient
+
+
+def run(messages, rate, workers, retries, latency, error_rate):
+    with StubTwilioServer(latency=latency, error_rate=error_rate) as stub:
+        client = Client(
+            "ACstub", "token",
+            http_client=RedirectingHttpClient(stub.base_url)
+        )
+        notifier = Notifier(
+            client=client, max_workers=workers, rate_limit=rate,
+            max_retries=retries,
+        )
+        phone_numbers = [f"+1555{i:07d}" for i in range(messages)]
+
+        start = time.perf_counter()
+        results = notifier.send_texts("Benchmark", phone_numbers)
+        elapsed = time.perf_counter() - start
+
+    sent = sum(1 for r in results.values() if r["status"] == "sent")
+    attempts = sum(r["attempts"] for r in results.values())
+    print(f"Messages:    {messages}")
+    print(f"Sent:        {sent} ({messages - sent} failed)")
+    print(f"Attempts:    {attempts}")
+    print(f"Received:    {len(stub.messages)}")
+    print(f"Elapsed:     {elapsed:.2f} s")
+    print(f"Throughput:  {sent / elapsed:.1f} texts/s")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark text delivery")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=50,
+                        help="Rate limit in texts per second")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Stub Twilio API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of stub API calls that fail with 503")
+    args = parser.parse_args()
+    run(args.messages, args.rate, args.workers, args.retries, args.latency,
+        args.error_rate)
@@ -0,0 +1,143 @@
+"""
+Parse time and peak memory of the HTML parser backends used to count page
+elements, over saved copies of the Wegmans and Allentown pages
+
+    python -m vaccine_finder.benchmarks.parsers --save
+    python -m vaccine_finder.benchmarks.parsers --repeat 50
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+import requests
+from bs4 import BeautifulSoup
+
+from vaccine_finder.utils import (
+    HTML_PARSERS, PAGE_CHUNK_SIZE, etree, count_page_elements, send_request,
+)
+from vaccine_finder.benchmarks.stubs import synthetic_page
+from vaccine_finder.wegmans import finder as wegmans
+from vaccine_finder.allentown import finder as allentown
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+PAGES = {
+    "wegmans": (wegmans.AVAIL_ENDPOINT, wegmans.TOTAL_PAGE_ELEMENTS),
+    "allentown": (allentown.AVAIL_ENDPOINT, allentown.TOTAL_PAGE_ELEMENTS),
+}
+
+
+def save_pages():
+    """
+    Download the current pages to PAGES_DIR
+    """
+    os.makedirs(PAGES_DIR, exist_ok=True)
+    session = requests.Session()
+    for name, (url, _) in PAGES.items():
+        response = send_request(
+            session, "get", url, return_response=True,
+            headers={"User-Agent": "Vaccine-Finder"},
+        )
+        path = os.path.join(PAGES_DIR, f"{name}.html")
+        with open(path, "wb") as f:
+            f.write(response.content)
+        print(f"Saved {url} to {path}")
+
+
+def load_pages():
+    """
+    Load saved pages, falling back to synthetic pages of the threshold size
+    """
+    pages = {}
+    for name, (_, threshold) in PAGES.items():
+        path = os.path.join(PAGES_DIR, f"{name}.html")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                pages[name] = (f.read(), threshold)
+        else:
+            print(f"⚠️  No saved {name} page, using a synthetic page")
+            pages[name] = (synthetic_page(threshold), threshold)
+    return pages
+
+
+def chunks(text, size=PAGE_CHUNK_SIZE):
+    """
+    Split page text into chunks as they'd be streamed
+    """
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def soup_count(content, threshold):
+    """
+    Original check - full BeautifulSoup tree with html.parser
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    return len([t for t in soup.findAll()])
+
+
+def measure(func, repeat):
+    """
+    Return (result, best seconds, mean seconds, peak traced bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, min(times), sum(times) / len(times), peak
+
+
+def run(repeat=20):
+    backends = [p for p in HTML_PARSERS if p != "lxml" or etree is not None]
+    pages = load_pages()
+    print(
+        f"{'page':<10} {'backend':<22} {'count':>6} {'best ms':>9} "
+        f"{'mean ms':>9} {'peak KiB':>9}"
+    )
+    for name, (content, threshold) in pages.items():
+        reference = soup_count(content, threshold)
+        # Streamed pages are decoded before they're counted
+        text = content.decode("utf-8", errors="replace")
+        cases = [("bs4 tree", lambda: soup_count(content, threshold))]
+        for backend in backends:
+            cases.append((backend, lambda b=backend: count_page_elements(
+                chunks(text), float("inf"), parser=b
+            ).count))
+            cases.append((f"{backend} early stop", lambda b=backend: (
+                count_page_elements(
+                    chunks(text), threshold, parser=b
+                ).count
+            )))
+
+        for label, func in cases:
+            count, best, mean, peak = measure(func, repeat)
+            flag = ""
+            if "early stop" not in label and count != reference:
+                flag = f" MISMATCH (expected {reference})"
+            print(
+                f"{name:<10} {label:<22} {count:>6} {best * 1000:>9.3f} "
+                f"{mean * 1000:>9.3f} {peak / 1024:>9.1f}{flag}"
+            )
+    if etree is not None:
+        print("Note: peak memory only traces Python allocations, not libxml2")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark HTML parser backends"
+    )
+    parser.add_argument(
+        "--save", action="store_true",
+        help="Download current copies of the pages before benchmarking"
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages()
+    run(repeat=args.repeat)
@@ -0,0 +1,426 @@
+"""
+Local stand-ins for the external APIs the finders and notifier call
+
+Serve the chain APIs from recorded responses, recording missing ones from
+the real sites, and synthetic data where nothing was recorded:
+
+    python -m vaccine_finder.benchmarks.stubs --cassettes cassettes --record
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from vaccine_finder.riteaid import finder as riteaid
+from vaccine_finder.walgreens import finder as walgreens
+from vaccine_finder.wegmans import finder as wegmans
+from vaccine_finder.allentown import finder as allentown
+
+ORIGINAL_HOST_HEADER = "X-Stub-Original-Host"
+Location = namedtuple("Location", ["latitude", "longitude"])
+
+
+class StubServer(object):
+    """
+    Threaded HTTP server on localhost running a handler class that has
+    access to this object as `self.server.stub`
+    """
+
+    handler_class = None
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0):
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(
+            ("127.0.0.1", self.port), self.handler_class
+        )
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def inject(self):
+        """
+        Sleep for the configured latency and return True if this request
+        should fail
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        return random.random() < self.error_rate
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_body(status, body, "application/json", headers)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TwilioHandler(StubHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        form = {
+            k: v[0] for k, v in parse_qs(self.read_body().decode()).items()
+        }
+        if not self.path.endswith("/Messages.json"):
+            return self.send_json(404, {"code": 20404, "status": 404})
+        if stub.inject():
+            return self.send_json(
+                503, {"code": 20503, "message": "Service unavailable",
+                      "status": 503}
+            )
+
+        sid = f"SM{uuid.uuid4().hex}"
+        with stub.lock:
+            stub.messages.append({
+                "sid": sid, "to": form.get("To"), "body": form.get("Body"),
+                "received_at": time.time(),
+            })
+        self.send_json(201, {
+            "sid": sid, "status": "queued", "to": form.get("To"),
+            "from": form.get("From"), "body": form.get("Body"),
+        })
+
+
+class StubTwilioServer(StubServer):
+    """
+    Stand-in for the Twilio Messages API that records every message sent
+    """
+
+    handler_class = TwilioHandler
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+        self.lock = threading.Lock()
+
+
+def synthetic_page(elements):
+    """
+    HTML document with exactly the given number of elements
+    """
+    items = "".join(
+        f'<li class="slot"><a href="#{i}">Slot {i}</a></li>'
+        for i in range((elements - 7) // 2)
+    )
+    padding = "<br>" * ((elements - 7) % 2)
+    return (
+        "<!DOCTYPE html><html><head><title>Clinic</title>"
+        "<script>var s = '<div>';</script></head>"
+        f"<body><div><ul>{items}</ul>{padding}</div></body></html>"
+    ).encode("utf-8")
+
+
+class ChainData(object):
+    """
+    Synthetic state of every chain served by StubChainServer. Tests flip
+    availability by changing open_stores, walgreens_open and open_pages
+    """
+
+    def __init__(
+        self, stores=100, open_rate=0.0, center=(40.1, -75.4), spread=0.5,
+        seed=0
+    ):
+        rng = random.Random(seed)
+        self.stores = [
+            {
+                "storeNumber": 1000 + i,
+                "address": f"{i} Main St",
+                "city": "Town",
+                "state": "PA",
+                "zipcode": "19403",
+                "latitude": center[0] + rng.uniform(-spread, spread),
+                "longitude": center[1] + rng.uniform(-spread, spread),
+            }
+            for i in range(stores)
+        ]
+        self.open_stores = {
+            s["storeNumber"] for s in self.stores if rng.random() < open_rate
+        }
+        self.walgreens_open = open_rate > 0
+        self.open_pages = set()
+        self.lock = threading.Lock()
+
+    def riteaid_stores(self, query, body):
+        return {"Data": {"stores": self.stores}, "Status": "SUCCESS"}
+
+    def riteaid_slots(self, query, body):
+        store_number = int(query.get("storeNumber", ["0"])[0])
+        is_open = store_number in self.open_stores
+        return {
+            "Data": {"slots": {"1": is_open, "2": False}},
+            "Status": "SUCCESS",
+        }
+
+    def walgreens_availability(self, query, body):
+        return {"appointmentsAvailable": self.walgreens_open}
+
+    def page(self, name, threshold):
+        return synthetic_page(
+            threshold + 10 if name in self.open_pages else threshold
+        )
+
+
+def _route(url):
+    parts = urlsplit(url)
+    return parts.netloc, parts.path
+
+
+# (method, host, path) of every endpoint constant -> ChainData responder
+JSON_ROUTES = {
+    ("GET",) + _route(riteaid.GET_STORES_ENDPOINT): "riteaid_stores",
+    ("GET",) + _route(riteaid.CHECK_SLOTS_ENDPOINT): "riteaid_slots",
+    ("POST",) + _route(walgreens.AVAIL_ENDPOINT): "walgreens_availability",
+}
+PAGE_ROUTES = {
+    ("GET",) + _route(wegmans.AVAIL_ENDPOINT): (
+        "wegmans", wegmans.TOTAL_PAGE_ELEMENTS
+    ),
+    ("GET",) + _route(allentown.AVAIL_ENDPOINT): (
+        "allentown", allentown.TOTAL_PAGE_ELEMENTS
+    ),
+}
+
+
+class Cassettes(object):
+    """
+    Recorded responses, one JSON file per method, host, path and query
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.responses = {}
+        if directory and os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name)) as f:
+                        cassette = json.load(f)
+                    self.responses[cassette["key"]] = cassette
+
+    @staticmethod
+    def key(method, host, path, query=""):
+        return f"{method} {host}{path}?{query}"
+
+    def get(self, method, host, path, query):
+        """
+        Recorded response for the exact query, else for any query
+        """
+        return (
+            self.responses.get(self.key(method, host, path, query)) or
+            self.responses.get(self.key(method, host, path))
+        )
+
+    def save(self, method, host, path, query, response):
+        cassette = {
+            "key": self.key(method, host, path, query),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type", ""),
+            "body": base64.b64encode(response.content).decode("ascii"),
+        }
+        self.responses[cassette["key"]] = cassette
+        os.makedirs(self.directory, exist_ok=True)
+        name = hashlib.sha1(cassette["key"].encode()).hexdigest()
+        with open(os.path.join(self.directory, f"{name}.json"), "w") as f:
+            json.dump(cassette, f, indent=2)
+
+
+class ChainHandler(StubHandler):
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def respond(self, method):
+        stub = self.server.stub
+        host = self.headers.get(ORIGINAL_HOST_HEADER) or self.headers["Host"]
+        parts = urlsplit(self.path)
+        body = self.read_body()
+        with stub.lock:
+            stub.requests[(method, host, parts.path)] += 1
+
+        if stub.inject():
+            return self.send_json(503, {"error": "injected error"})
+
+        cassette = stub.cassettes.get(method, host, parts.path, parts.query)
+        if cassette is None and stub.record:
+            cassette = self.record(method, host, parts, body)
+        if cassette is not None:
+            return self.send_body(
+                cassette["status"], base64.b64decode(cassette["body"]),
+                cassette["content_type"]
+            )
+
+        route = (method, host, parts.path)
+        if route in JSON_ROUTES:
+            responder = getattr(stub.data, JSON_ROUTES[route])
+            return self.send_json(
+                200, responder(parse_qs(parts.query), body)
+            )
+        if route in PAGE_ROUTES:
+            content = stub.data.page(*PAGE_ROUTES[route])
+            etag = f'"{hashlib.sha1(content).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self.send_body(304, b"", "text/html", {"ETag": etag})
+            return self.send_body(
+                200, content, "text/html; charset=utf-8", {"ETag": etag}
+            )
+        self.send_json(
+            404, {"error": f"No stub for {method} {host}{parts.path}"}
+        )
+
+    def record(self, method, host, parts, body):
+        stub = self.server.stub
+        headers = {
+            k: v for k, v in self.headers.items()
+            if k.lower() not in ("host", ORIGINAL_HOST_HEADER.lower(),
+                                 "content-length", "accept-encoding")
+        }
+        response = requests.request(
+            method, f"https://{host}{self.path}", headers=headers,
+            data=body or None, timeout=30
+        )
+        with stub.lock:
+            stub.cassettes.save(method, host, parts.path, parts.query,
+                                response)
+        return stub.cassettes.get(method, host, parts.path, parts.query)
+
+
+class StubChainServer(StubServer):
+    """
+    Stand-in for every chain endpoint the finders call. Serves recorded
+    responses from a cassette directory, records missing ones from the
+    real sites when record is True and falls back to synthetic ChainData
+    """
+
+    handler_class = ChainHandler
+
+    def __init__(self, *args, data=None, cassettes=None, record=False,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data = data or ChainData()
+        self.cassettes = Cassettes(cassettes)
+        self.record = record and cassettes is not None
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+
+class StubRedirectAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends every request to a stub server, passing
+    the original host in a header
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.headers[ORIGINAL_HOST_HEADER] = parts.netloc
+        request.url = self.base_url + parts.path
+        if parts.query:
+            request.url += f"?{parts.query}"
+        return super().send(request, **kwargs)
+
+
+class StubGeocoder(object):
+    """
+    Stand-in for Nominatim that puts every zip code at the same place
+    """
+
+    def __init__(self, latitude=40.1, longitude=-75.4):
+        self.location = Location(latitude, longitude)
+
+    def geocode(self, query):
+        return self.location
+
+
+def route_to_stub(finder, base_url, pool_maxsize=32):
+    """
+    Send all of a finder's HTTP requests to a stub server
+    """
+    adapter = StubRedirectAdapter(base_url, pool_maxsize=pool_maxsize)
+    finder.session.mount("https://", adapter)
+    finder.session.mount("http://", adapter)
+    if hasattr(finder, "geocoder"):
+        finder.geocoder.fallback = StubGeocoder()
+    return finder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the chain API stub")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--cassettes", help="Recorded responses directory")
+    parser.add_argument("--record", action="store_true",
+                        help="Record responses missing from --cassettes")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stores", type=int, default=100)
+    parser.add_argument("--open-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = StubChainServer(
+        port=args.port, latency=args.latency, error_rate=args.error_rate,
+        data=ChainData(stores=args.stores, open_rate=args.open_rate),
+        cassettes=args.cassettes, record=args.record,
+    )
+    print(f"Serving chain stub at {stub.start()}")
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,106 @@
+import time
+import logging
+import threading
+
+import requests
+
+from vaccine_finder.config import (
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+)
+from vaccine_finder.metrics import incr_metric, set_metric
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request to an endpoint that is down
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of one endpoint in this process
+
+    After failure_threshold failed requests in a row the circuit opens and
+    requests fail fast with CircuitOpenError. After reset_timeout seconds
+    one request is let through to probe the endpoint. The circuit closes if
+    it succeeds and opens again otherwise. A probe without an outcome after
+    another reset_timeout seconds (e.g. its job was killed) is given up on
+    and a new one let through
+    """
+
+    def __init__(
+        self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_started_at = 0
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Raise CircuitOpenError if the request must not be sent
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if (
+                self.state == OPEN
+                and now - self.opened_at >= self.reset_timeout
+            ):
+                self.probe_started_at = now
+                self._transition(HALF_OPEN)
+                return
+            if (
+                self.state == HALF_OPEN
+                and now - self.probe_started_at >= self.reset_timeout
+            ):
+                self.logger.warning(
+                    f"Probe of {self.name} timed out, probing again"
+                )
+                self.probe_started_at = now
+                return
+        incr_metric("circuit_rejections", {"endpoint": self.name})
+        raise CircuitOpenError(f"Circuit of {self.name} is {self.state}")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and self.failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        self.state = state
+        if state == OPEN:
+            self.logger.warning(
+                f"🔌 Circuit of {self.name} opened after {self.failures} "
+                f"failures, probing again in {self.reset_timeout} seconds"
+            )
+        else:
+            self.logger.info(f"Circuit of {self.name} is {state}")
+        incr_metric(
+            "circuit_transitions", {"endpoint": self.name, "state": state}
+        )
+        set_metric(
+            "circuit_open", {"endpoint": self.name}, int(state != CLOSED)
+        )
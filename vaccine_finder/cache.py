@@ -0,0 +1,145 @@
+import json
+import math
+import time
+import uuid
+import logging
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import (
+    AVAILABILITY_CACHE_TTL, AVAILABILITY_CACHE_WAIT,
+)
+from vaccine_finder.metrics import incr_metric
+from vaccine_finder.utils import get_redis_connection
+
+CACHE_KEY = "vaccine_finder:cache:{name}:{key}"
+FETCH_LOCK_KEY = "vaccine_finder:cache:{name}:{key}:fetching"
+# Seconds between checks for a result another caller is fetching
+POLL_INTERVAL = 0.1
+
+# Cache the value (ARGV[1]) for ARGV[2] seconds and release the fetch lock
+# if we still hold it
+FILL_SCRIPT = """
+redis.call("set", KEYS[1], ARGV[1], "EX", ARGV[2])
+if redis.call("get", KEYS[2]) == ARGV[3] then
+    redis.call("del", KEYS[2])
+end
+"""
+
+# Release the fetch lock if we still hold it
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class AvailabilityCache(object):
+    """
+    Short lived Redis cache of upstream availability responses, shared by
+    every worker, with single-flight fetches
+
+    The first caller of a key takes its fetch lock and fetches, callers of
+    the same key meanwhile wait for that result instead of fetching it
+    again. Results are reused for ttl seconds, errors aren't cached. If
+    Redis is unavailable every caller fetches
+
+    Lookups are counted in availability_cache by result: hit, coalesced
+    (waited for another caller's fetch) and miss
+    """
+
+    def __init__(
+        self, name, connection=None, ttl=AVAILABILITY_CACHE_TTL,
+        wait=AVAILABILITY_CACHE_WAIT,
+    ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.connection = connection or get_redis_connection()
+        self.ttl = ttl
+        self.wait = wait
+        self._fill = self.connection.register_script(FILL_SCRIPT)
+        self._release = self.connection.register_script(RELEASE_SCRIPT)
+
+    def get(self, key, fetch):
+        """
+        Return the cached response of key, or fetch() it. fetch must
+        return something JSON serializable
+        """
+        if self.ttl <= 0:
+            return fetch()
+        cache_key = CACHE_KEY.format(name=self.name, key=key)
+        lock_key = FETCH_LOCK_KEY.format(name=self.name, key=key)
+        token = uuid.uuid4().hex
+        try:
+            cached = self.connection.get(cache_key)
+            if cached is not None:
+                self._count("hit")
+                return json.loads(cached)
+            leader = self.connection.set(
+                lock_key, token, nx=True, ex=max(1, math.ceil(self.wait))
+            )
+            if leader:
+                # Another caller may have cached it since the first get
+                cached = self.connection.get(cache_key)
+                if cached is not None:
+                    self._release_lock(lock_key, token)
+                    self._count("hit")
+                    return json.loads(cached)
+            else:
+                cached = self._wait_for(cache_key, lock_key)
+                if cached is not None:
+                    self._count("coalesced")
+                    return json.loads(cached)
+                # The fetching caller failed or is too slow, fetch too
+                leader = self.connection.set(
+                    lock_key, token, nx=True,
+                    ex=max(1, math.ceil(self.wait)),
+                )
+        except RedisError as err:
+            self.logger.warning(f"Availability cache unavailable: {err}")
+            self._count("miss")
+            return fetch()
+
+        self._count("miss")
+        try:
+            value = fetch()
+        except Exception:
+            if leader:
+                self._release_lock(lock_key, token)
+            raise
+        try:
+            self._fill(
+                keys=[cache_key, lock_key],
+                args=[json.dumps(value), self.ttl, token],
+            )
+        except RedisError as err:
+            self.logger.warning(f"Could not cache {key}: {err}")
+        return value
+
+    def _wait_for(self, cache_key, lock_key):
+        """
+        Wait while another caller holds the fetch lock. Return its cached
+        result, None if it didn't cache one within wait seconds
+        """
+        deadline = time.monotonic() + self.wait
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            pipe = self.connection.pipeline()
+            pipe.get(cache_key)
+            pipe.exists(lock_key)
+            cached, fetching = pipe.execute()
+            if cached is not None or not fetching:
+                return cached
+        return None
+
+    def _release_lock(self, lock_key, token):
+        try:
+            self._release(keys=[lock_key], args=[token])
+        except RedisError as err:
+            self.logger.warning(f"Could not release {lock_key}: {err}")
+
+    def _count(self, result):
+        incr_metric(
+            "availability_cache", {"cache": self.name, "result": result}
+        )
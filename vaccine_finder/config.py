@@ -8,12 +8,21 @@ VACCINE_FINDER_LOG_LEVEL = os.environ.get(
 ).upper()
 if not VACCINE_FINDER_LOG_LEVEL:
     VACCINE_FINDER_LOG_LEVEL = logging.INFO
+# text or json
+LOG_FORMAT = os.environ.get("VACCINE_FINDER_LOG_FORMAT", "text").lower()
+# Fraction of per store chatter (e.g. each store checked) that is logged
+LOG_SAMPLE_RATE = float(os.environ.get("VACCINE_FINDER_LOG_SAMPLE_RATE", 0.1))
 
 # Data
 ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
 DEFAULT_INPUT_FILE = os.path.abspath(
     os.environ.get("VACCINE_FINDER_INPUT_FILE", None)
 )
+# Region profiles, each with its own input file (see regions.py). Without
+# one, the deployment is a single region with DEFAULT_INPUT_FILE
+REGIONS_FILE = os.environ.get("VACCINE_FINDER_REGIONS_FILE")
+# Where finders read inputs from - the input file, or Redis (see inputs.py)
+INPUT_SOURCE = os.environ.get("VACCINE_FINDER_INPUT_SOURCE", "file").lower()
 
 # Connections
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
@@ -21,11 +30,28 @@ REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 TWILIO_ACCOUNT_ID = os.environ.get("TWILIO_ACCOUNT_ID")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER")
+# Point the Twilio client at a local stand-in, e.g. http://localhost:8089
+TWILIO_API_BASE_URL = os.environ.get("TWILIO_API_BASE_URL")
 
 # Jobs
 WINDOW_START = datetime.time(6, 0, 0, 0)  # 6 am
 WINDOW_END = datetime.time(23, 59, 0, 0)  # ~ 12 am
 JOB_INTERVAL = int(os.environ.get('JOB_INTERVAL', 900))
+# Adaptive scheduling - chains with changing results are polled every
+# ADAPTIVE_MIN_INTERVAL, quiet ones every JOB_INTERVAL and failing ones back
+# off exponentially up to ADAPTIVE_MAX_INTERVAL
+ADAPTIVE_MIN_INTERVAL = int(os.environ.get("ADAPTIVE_MIN_INTERVAL", 60))
+ADAPTIVE_MAX_INTERVAL = int(os.environ.get("ADAPTIVE_MAX_INTERVAL", 3600))
+ADAPTIVE_JITTER = float(os.environ.get("ADAPTIVE_JITTER", 0.1))
+SCHEDULER_TICK = int(os.environ.get("SCHEDULER_TICK", 5))
+# separate: one rq job per finder, combined: one job running all finders
+JOB_MODE = os.environ.get("VACCINE_FINDER_JOB_MODE", "separate").lower()
+ALL_CHAINS_DEADLINE = int(os.environ.get("ALL_CHAINS_DEADLINE", 600))
+FINDER_TIMEOUT = int(os.environ.get("FINDER_TIMEOUT", 300))
+# Hard rq timeout of finder jobs, also how long a job's lease is held at most
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", ALL_CHAINS_DEADLINE + 60))
+# Finder jobs aren't enqueued while the queue holds this many jobs
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", 10))
 
 # Finder
 DEFAULT_PHONE_NUM = "+14846206937"
@@ -33,3 +59,87 @@ NOTIFY_VACCINE_USERS = bool(int(os.environ.get("NOTIFY_VACCINE_USERS", False)))
 DEBUG_VACCINE_FINDER = bool(int(os.environ.get("DEBUG_VACCINE_FINDER", False)))
 DEFAULT_ZIP_CODES = [19403]
 DEFAULT_RADIUS = 50
+
+# Geocoding
+ZIP_CENTROIDS_FILE = os.environ.get(
+    "ZIP_CENTROIDS_FILE",
+    os.path.join(ROOT_DIR, "vaccine_finder", "data", "zip_centroids.bin")
+)
+ZIP_CACHE_SIZE = int(os.environ.get("ZIP_CACHE_SIZE", 4096))
+
+# Subscriber targeting - grid cell size in miles of the subscriber index
+# and the most stores listed in a subscriber's text
+SUBSCRIBER_CELL_SIZE = float(os.environ.get("SUBSCRIBER_CELL_SIZE", 25))
+SUBSCRIBER_MAX_STORES = int(os.environ.get("SUBSCRIBER_MAX_STORES", 3))
+
+# Notifications
+NOTIFY_ASYNC = bool(int(os.environ.get("NOTIFY_ASYNC", True)))
+NOTIFY_QUEUE = os.environ.get("NOTIFY_QUEUE", "notifications")
+NOTIFY_MAX_WORKERS = int(os.environ.get("NOTIFY_MAX_WORKERS", 8))
+# Max texts sent per second by all delivery jobs together. A delivery job
+# times out NOTIFY_TIMEOUT_MARGIN seconds after its texts should be sent
+NOTIFY_RATE_LIMIT = float(os.environ.get("NOTIFY_RATE_LIMIT", 1))
+NOTIFY_TIMEOUT_MARGIN = int(os.environ.get("NOTIFY_TIMEOUT_MARGIN", 180))
+NOTIFY_MAX_RETRIES = int(os.environ.get("NOTIFY_MAX_RETRIES", 3))
+NOTIFY_RESULT_TTL = int(os.environ.get("NOTIFY_RESULT_TTL", 7 * 86400))
+# Min seconds between notifications from one finder
+NOTIFY_COOLDOWN = int(os.environ.get("NOTIFY_COOLDOWN", 1800))
+
+# Upstream requests - transient errors are retried HTTP_MAX_RETRIES times
+# with exponential backoff from HTTP_BACKOFF seconds. An endpoint's circuit
+# opens after CIRCUIT_FAILURE_THRESHOLD failures in a row and is probed
+# again after CIRCUIT_RESET_TIMEOUT seconds
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 2))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", 10))
+CIRCUIT_FAILURE_THRESHOLD = int(
+    os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5)
+)
+CIRCUIT_RESET_TIMEOUT = int(os.environ.get("CIRCUIT_RESET_TIMEOUT", 60))
+
+# Availability cache - store and query point results are shared by all
+# workers for AVAILABILITY_CACHE_TTL seconds, 0 is off. Callers wait up to
+# AVAILABILITY_CACHE_WAIT seconds for a result another caller is fetching
+AVAILABILITY_CACHE_TTL = int(os.environ.get("AVAILABILITY_CACHE_TTL", 30))
+AVAILABILITY_CACHE_WAIT = float(os.environ.get("AVAILABILITY_CACHE_WAIT", 30))
+
+# Upstream rate limits - requests per second by host shared by all workers,
+# e.g. www.riteaid.com=20,www.walgreens.com=5. Other hosts get
+# RATE_LIMIT_DEFAULT, 0 is unlimited. Throttled hosts are slowed down to as
+# little as RATE_LIMIT_MIN_FACTOR of their rate, which recovers by
+# RATE_LIMIT_RECOVERY of it per second
+RATE_LIMITS = os.environ.get("RATE_LIMITS", "")
+RATE_LIMIT_DEFAULT = float(os.environ.get("RATE_LIMIT_DEFAULT", 0))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 10))
+RATE_LIMIT_MIN_FACTOR = float(os.environ.get("RATE_LIMIT_MIN_FACTOR", 0.05))
+RATE_LIMIT_RECOVERY = float(os.environ.get("RATE_LIMIT_RECOVERY", 0.01))
+
+# Metrics - recorded in process and added to Redis every
+# METRICS_FLUSH_INTERVAL seconds, served by python -m vaccine_finder.metrics
+METRICS_ENABLED = bool(int(os.environ.get("METRICS_ENABLED", True)))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 10))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+# Profiling - fraction of finder runs profiled, 0 is off
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_TTL = int(os.environ.get("PROFILE_TTL", 7 * 86400))
+# Profiles kept per finder
+PROFILE_MAX_RUNS = int(os.environ.get("PROFILE_MAX_RUNS", 50))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 25))
+
+# HTML parser backend for page element counts: html.parser, or lxml if it's
+# installed (pip install lxml)
+HTML_PARSER = os.environ.get(
+    "VACCINE_FINDER_HTML_PARSER", "html.parser"
+).lower()
+
+# RiteAid
+RITEAID_MAX_WORKERS = int(os.environ.get("RITEAID_MAX_WORKERS", 8))
+# Split RiteAid sweeps into this many rq sub-jobs (0 or 1: one job), but
+# no shard smaller than RITEAID_MIN_SHARD_SIZE stores
+RITEAID_SHARDS = int(os.environ.get("RITEAID_SHARDS", 0))
+RITEAID_MIN_SHARD_SIZE = int(os.environ.get("RITEAID_MIN_SHARD_SIZE", 25))
+STORE_CATALOG_TTL = int(os.environ.get("STORE_CATALOG_TTL", 86400))
+STORE_CATALOG_REFRESH_INTERVAL = int(
+    os.environ.get("STORE_CATALOG_REFRESH_INTERVAL", 21600)
+)
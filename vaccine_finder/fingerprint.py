@@ -0,0 +1,194 @@
+import codecs
+import hashlib
+import logging
+import re
+from collections import namedtuple
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.utils import (
+    get_redis_connection, send_request, count_page_elements, PAGE_CHUNK_SIZE,
+)
+
+PAGE_FINGERPRINT_KEY = "vaccine_finder:pages:{url_hash}"
+WHITESPACE = re.compile(r"\s+")
+
+# result is whether the page has more than the threshold's elements. digest
+# is None when the page was only read up to the threshold
+Page = namedtuple(
+    "Page", ["url", "digest", "etag", "last_modified", "changed", "result",
+             "elements"]
+)
+
+
+class Fingerprint(object):
+    """
+    Hash of page content with whitespace normalized, fed the content in
+    pieces. Gives the same digest as fingerprint of the whole content
+    """
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.started = False
+        # Whitespace since the last text, dropped if nothing follows it
+        self.pending_space = False
+
+    def update(self, text):
+        normalized = WHITESPACE.sub(" ", text)
+        body = normalized.strip(" ")
+        if not body:
+            self.pending_space = self.pending_space or bool(normalized)
+            return
+        if self.started and (self.pending_space or normalized[0] == " "):
+            self.hasher.update(b" ")
+        self.hasher.update(body.encode("utf-8"))
+        self.started = True
+        self.pending_space = normalized[-1] == " "
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def fingerprint(content):
+    """
+    Hash page content with whitespace normalized
+    """
+    normalized = WHITESPACE.sub(" ", content).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class PageFingerprintCache(object):
+    """
+    Remember the fingerprint, HTTP validators and availability result of
+    the last check of a page so unchanged pages aren't downloaded again
+    when the server answers conditional GETs with 304
+    """
+
+    def __init__(self, connection=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.connection = connection or get_redis_connection()
+
+    def check(self, session, url, threshold, force=False, **kwargs):
+        """
+        Fetch url and return its Page, whose result is whether it has more
+        than threshold elements. The page's check is saved, unless forced
+        to fetch the page unconditionally, for debug runs
+        """
+        page = self.fetch(
+            session, url, threshold, conditional=not force, **kwargs
+        )
+        if not force:
+            self.save(page, page.result)
+        return page
+
+    def fetch(
+        self, session, url, threshold, headers=None, conditional=True,
+        **kwargs
+    ):
+        """
+        Conditionally GET url and count its elements
+
+        The body is streamed, each chunk is fingerprinted and counted as it
+        arrives. Reading stops as soon as the count passes threshold. Only
+        pages read to the end get a digest, Page.changed is False when it's
+        the same as the last saved check's. A 304 is unchanged and gives
+        the last saved check's result
+        """
+        state = self._load(url)
+        headers = dict(headers or {})
+        if conditional and state.get("result") is not None:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        response = send_request(
+            session, "get", url, return_response=True, headers=headers,
+            stream=True, **kwargs
+        )
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 304:
+            self.logger.info(f"Page not modified: {url}")
+            response.close()
+            return Page(
+                url, state.get("digest"), state.get("etag"),
+                state.get("last_modified"), False, state["result"], None
+            )
+
+        hasher = Fingerprint()
+        try:
+            elements = count_page_elements(
+                self._read(response, hasher), threshold
+            )
+        finally:
+            response.close()
+        if elements.exceeded:
+            self.logger.info(
+                f"Page has more than {threshold} elements, stopped reading: "
+                f"{url}"
+            )
+            return Page(
+                url, None, etag, last_modified,
+                state.get("result") is not True, True, elements
+            )
+
+        digest = hasher.hexdigest()
+        changed = (
+            state.get("result") is None or digest != state.get("digest")
+        )
+        if not changed:
+            self.logger.info(f"Page fingerprint unchanged: {url}")
+        return Page(
+            url, digest, etag, last_modified, changed, False, elements
+        )
+
+    @staticmethod
+    def _read(response, hasher):
+        """
+        Decode a streamed body chunk by chunk, fingerprinting each chunk
+        """
+        try:
+            decoder = codecs.getincrementaldecoder(
+                response.encoding or "utf-8"
+            )
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")
+        decoder = decoder(errors="replace")
+        for chunk in response.iter_content(chunk_size=PAGE_CHUNK_SIZE):
+            text = decoder.decode(chunk)
+            hasher.update(text)
+            yield text
+        text = decoder.decode(b"", final=True)
+        hasher.update(text)
+        yield text
+
+    def save(self, page, result):
+        """
+        Save the fingerprint, validators and availability result of a page
+        """
+        mapping = {
+            "digest": page.digest or "",
+            "etag": page.etag or "",
+            "last_modified": page.last_modified or "",
+            "result": int(bool(result)),
+        }
+        try:
+            self.connection.hset(self._key(page.url), mapping=mapping)
+        except RedisError as err:
+            self.logger.warning(f"Could not save page fingerprint: {err}")
+
+    def _load(self, url):
+        try:
+            state = self.connection.hgetall(self._key(url))
+        except RedisError as err:
+            self.logger.warning(f"Page fingerprints unavailable: {err}")
+            return {}
+        state = {k.decode(): v.decode() for k, v in state.items()}
+        if "result" in state:
+            state["result"] = bool(int(state["result"]))
+        return state
+
+    def _key(self, url):
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return PAGE_FINGERPRINT_KEY.format(url_hash=url_hash)
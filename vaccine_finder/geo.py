@@ -0,0 +1,225 @@
+"""
+Zip code geocoding backed by an offline, memory-mapped centroid table
+
+The table is a sorted array of fixed size (zip, lat, lon) records so a lookup
+is a binary search over the mapped file and no parsing happens at startup.
+Build it from the Census ZCTA gazetteer file with:
+
+    python -m vaccine_finder.geo build 2020_Gaz_zcta_national.txt
+"""
+import argparse
+import csv
+import logging
+import math
+import mmap
+import os
+import struct
+from functools import lru_cache
+
+import numpy as np
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import ZIP_CENTROIDS_FILE, ZIP_CACHE_SIZE
+from vaccine_finder.utils import get_redis_connection, setup_logger
+
+MAGIC = b"ZIPC"
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<Iff")
+GEOCODE_CACHE_KEY = "vaccine_finder:geo:zip_centroids"
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = math.pi * EARTH_RADIUS_MILES / 180
+
+logger = logging.getLogger(__name__)
+
+
+class ZipCentroidTable(object):
+    """
+    Read only zip code -> (latitude, longitude) table in a mapped file
+    """
+
+    def __init__(self, path=ZIP_CENTROIDS_FILE):
+        self.path = path
+        self._mmap = None
+        self.size = 0
+        if not os.path.exists(path):
+            logger.warning(f"⚠️  Zip centroid table {path} not found")
+            return
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a zip centroid table")
+
+    def lookup(self, zip_code):
+        """
+        Return (latitude, longitude) of zip code or None if not in the table
+        """
+        if not self._mmap:
+            return None
+        zip_code = int(zip_code)
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, lat, lon = RECORD.unpack_from(
+                self._mmap, HEADER.size + mid * RECORD.size
+            )
+            if key < zip_code:
+                lo = mid + 1
+            elif key > zip_code:
+                hi = mid
+            else:
+                return lat, lon
+        return None
+
+
+class ZipGeocoder(object):
+    """
+    Resolve zip codes to (latitude, longitude)
+
+    Lookups go to an in-process LRU, then the offline table, then the
+    shared Redis cache of past fallback results and only then to the
+    fallback geopy geocoder (e.g. Nominatim), whose answers are written back
+    to the Redis cache
+    """
+
+    def __init__(
+        self, fallback=None, table=None, connection=None,
+        cache_size=ZIP_CACHE_SIZE
+    ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.fallback = fallback
+        self.table = table or ZipCentroidTable()
+        self.connection = connection or get_redis_connection()
+        self.locate = lru_cache(maxsize=cache_size)(self._locate)
+
+    def _locate(self, zip_code):
+        zip_code = str(zip_code)
+        location = self.table.lookup(zip_code)
+        if location:
+            return location
+
+        try:
+            cached = self.connection.hget(GEOCODE_CACHE_KEY, zip_code)
+        except RedisError as err:
+            self.logger.warning(f"Geocode cache unavailable: {err}")
+            cached = None
+        if cached:
+            lat, lon = cached.decode().split(",")
+            return float(lat), float(lon)
+
+        if not self.fallback:
+            raise LookupError(f"Zip code {zip_code} not found")
+
+        self.logger.info(f"Geocoding zip code {zip_code} with fallback")
+        loc = self.fallback.geocode(zip_code)
+        if not loc:
+            raise LookupError(f"Zip code {zip_code} could not be geocoded")
+        try:
+            self.connection.hset(
+                GEOCODE_CACHE_KEY, zip_code,
+                f"{loc.latitude},{loc.longitude}"
+            )
+        except RedisError as err:
+            self.logger.warning(f"Could not cache geocode: {err}")
+        return loc.latitude, loc.longitude
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in miles between two points
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+def haversine_matrix(lat1, lon1, lat2, lon2):
+    """
+    Great circle distances in miles between every point of one array of
+    latitudes and longitudes (rows) and every point of another (columns)
+    """
+    lat1, lon1 = np.radians(lat1)[:, None], np.radians(lon1)[:, None]
+    lat2, lon2 = np.radians(lat2)[None, :], np.radians(lon2)[None, :]
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2 +
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class LocalProjection(object):
+    """
+    Equirectangular projection to miles around a reference latitude. Good
+    enough for metro sized areas, which is all the finders query
+    """
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.x_scale = MILES_PER_DEGREE * math.cos(math.radians(latitude))
+
+    def to_xy(self, latitude, longitude):
+        return (
+            (longitude - self.longitude) * self.x_scale,
+            (latitude - self.latitude) * MILES_PER_DEGREE,
+        )
+
+    def to_latlon(self, x, y):
+        return (
+            self.latitude + y / MILES_PER_DEGREE,
+            self.longitude + x / self.x_scale,
+        )
+
+
+def build_table(input_file, output_file=ZIP_CENTROIDS_FILE):
+    """
+    Build the zip centroid table from a Census ZCTA gazetteer file (tab
+    separated, GEOID/INTPTLAT/INTPTLONG columns) or a CSV file with
+    zip_code,latitude,longitude columns
+    """
+    with open(input_file, newline="") as f:
+        dialect = "excel-tab" if "\t" in f.readline() else "excel"
+        f.seek(0)
+        records = []
+        for row in csv.DictReader(f, dialect=dialect):
+            row = {k.strip(): v.strip() for k, v in row.items()}
+            if "GEOID" in row:
+                values = row["GEOID"], row["INTPTLAT"], row["INTPTLONG"]
+            else:
+                values = row["zip_code"], row["latitude"], row["longitude"]
+            records.append((int(values[0]), float(values[1]),
+                            float(values[2])))
+    records.sort()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records)))
+        for record in records:
+            f.write(RECORD.pack(*record))
+    logger.info(f"Wrote {len(records)} zip centroids to {output_file}")
+    return len(records)
+
+
+if __name__ == "__main__":
+    setup_logger()
+    parser = argparse.ArgumentParser(description="Zip code centroid table")
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Build the centroid table")
+    build.add_argument("input_file")
+    build.add_argument("--output", default=ZIP_CENTROIDS_FILE)
+    lookup = subparsers.add_parser("lookup", help="Look up zip codes")
+    lookup.add_argument("zip_codes", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_table(args.input_file, args.output)
+    elif args.command == "lookup":
+        table = ZipCentroidTable()
+        for zip_code in args.zip_codes:
+            print(zip_code, table.lookup(zip_code))
+    else:
+        parser.print_help()
@@ -0,0 +1,305 @@
+"""
+Subscribers and location of each region kept in Redis hashes, shared by
+every worker
+
+Every change bumps a version counter and records the version in a change
+log, so a worker that has version v only reads what changed after v. Load
+the existing input file format with:
+
+    python -m vaccine_finder.inputs import dev.inputs.json
+
+and change single subscribers with the add and remove commands. Regions
+other than the default one are picked with --region NAME before the command
+"""
+import json
+import argparse
+import logging
+import threading
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import DEFAULT_ZIP_CODES, DEFAULT_RADIUS
+from vaccine_finder.utils import get_redis_connection, setup_logger
+from vaccine_finder.subscribers import parse_subscriber
+from vaccine_finder.regions import DEFAULT_REGION
+
+# Key prefix of the default region's inputs, and of the other regions'
+INPUTS_KEY = "vaccine_finder:inputs"
+REGION_INPUTS_KEY = "vaccine_finder:inputs:{region}"
+VERSION_KEY = "{prefix}:version"
+# Version of the last import, workers that are older reload everything
+RESET_KEY = "{prefix}:reset"
+# Change log, field -> version of its last change
+CHANGES_KEY = "{prefix}:changes"
+SUBSCRIBERS_KEY = "{prefix}:subscribers"
+LOCATION_KEY = "{prefix}:location"
+LOCATION_FIELD = "location"
+SUBSCRIBER_FIELD = "subscriber:{phone_number}"
+IMPORT_BATCH_SIZE = 10000
+
+# Bump the version and log the changed fields (ARGV) under it
+CHANGE_SCRIPT = """
+local version = redis.call("incr", KEYS[1])
+for i = 1, #ARGV do
+    redis.call("zadd", KEYS[2], version, ARGV[i])
+end
+return version
+"""
+
+# Bump the version and mark it as a reset
+RESET_SCRIPT = """
+local version = redis.call("incr", KEYS[1])
+redis.call("set", KEYS[2], version)
+return version
+"""
+
+
+class InputStore(object):
+    """
+    This process' copy of a region's subscribers and location in Redis,
+    refreshed with only the changes since the last refresh
+
+    subscribers (emails by phone number), subscriber_locations,
+    zip_codes and radius are replaced, never changed in place, so finders
+    sharing them can read them while another thread refreshes
+    """
+
+    def __init__(self, connection=None, region=DEFAULT_REGION):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.connection = connection or get_redis_connection()
+        self.region = region
+        prefix = (
+            INPUTS_KEY if region == DEFAULT_REGION
+            else REGION_INPUTS_KEY.format(region=region)
+        )
+        self.version_key = VERSION_KEY.format(prefix=prefix)
+        self.reset_key = RESET_KEY.format(prefix=prefix)
+        self.changes_key = CHANGES_KEY.format(prefix=prefix)
+        self.subscribers_key = SUBSCRIBERS_KEY.format(prefix=prefix)
+        self.location_key = LOCATION_KEY.format(prefix=prefix)
+        self.version = 0
+        self.zip_codes = DEFAULT_ZIP_CODES
+        self.radius = DEFAULT_RADIUS
+        self.subscribers = {}
+        self.subscriber_locations = {}
+        self.lock = threading.Lock()
+        self._change = self.connection.register_script(CHANGE_SCRIPT)
+        self._reset = self.connection.register_script(RESET_SCRIPT)
+
+    def refresh(self):
+        """
+        Read what changed since the last refresh, one Redis call if
+        nothing did. Return the version, 0 if nothing was ever imported
+        """
+        with self.lock:
+            try:
+                version = int(self.connection.get(self.version_key) or 0)
+                if version != self.version:
+                    reset = int(self.connection.get(self.reset_key) or 0)
+                    if self.version < reset or version < self.version:
+                        self._load_all()
+                    else:
+                        self._load_changes(version)
+            except RedisError as err:
+                self.logger.warning(f"Input store unavailable: {err}")
+            return self.version
+
+    def _load_all(self):
+        pipe = self.connection.pipeline()
+        pipe.get(self.version_key)
+        pipe.hgetall(self.location_key)
+        pipe.hgetall(self.subscribers_key)
+        version, location, subscribers = pipe.execute()
+        self._set_location(location)
+        emails, locations = {}, {}
+        for phone_number, entry in subscribers.items():
+            self._set_subscriber(
+                emails, locations, phone_number.decode(), entry
+            )
+        self.subscribers, self.subscriber_locations = emails, locations
+        self.version = int(version or 0)
+        self.logger.info(
+            f"Loaded {len(self.subscribers)} subscribers, version "
+            f"{self.version}"
+        )
+
+    def _load_changes(self, version):
+        # Fields changed again after version are read at their newest,
+        # and again on the next refresh
+        fields = [
+            f.decode() for f in self.connection.zrangebyscore(
+                self.changes_key, self.version + 1, version
+            )
+        ]
+        phone_numbers = [
+            f.split(":", 1)[1] for f in fields if f != LOCATION_FIELD
+        ]
+        pipe = self.connection.pipeline()
+        if LOCATION_FIELD in fields:
+            pipe.hgetall(self.location_key)
+        if phone_numbers:
+            pipe.hmget(self.subscribers_key, phone_numbers)
+        results = iter(pipe.execute())
+        if LOCATION_FIELD in fields:
+            self._set_location(next(results))
+        if phone_numbers:
+            emails = dict(self.subscribers)
+            locations = dict(self.subscriber_locations)
+            for phone_number, entry in zip(phone_numbers, next(results)):
+                self._set_subscriber(emails, locations, phone_number, entry)
+            self.subscribers, self.subscriber_locations = emails, locations
+        self.version = version
+        self.logger.info(
+            f"Applied {len(fields)} input changes, version {version}"
+        )
+
+    def _set_location(self, location):
+        if location:
+            self.zip_codes = json.loads(location[b"zip_codes"])
+            self.radius = json.loads(location[b"radius"])
+
+    @staticmethod
+    def _set_subscriber(emails, locations, phone_number, entry):
+        locations.pop(phone_number, None)
+        if entry is None:
+            emails.pop(phone_number, None)
+            return
+        email, location = parse_subscriber(json.loads(entry))
+        emails[phone_number] = email
+        if location is not None:
+            locations[phone_number] = location
+
+    def import_inputs(self, inputs):
+        """
+        Replace all subscribers and the location with the inputs, in the
+        input file format. Return the new version
+        """
+        subscribers = list(inputs["subscribers"].items())
+        pipe = self.connection.pipeline()
+        pipe.delete(self.subscribers_key, self.changes_key)
+        for i in range(0, len(subscribers), IMPORT_BATCH_SIZE):
+            pipe.hset(self.subscribers_key, mapping={
+                ph: json.dumps(entry)
+                for ph, entry in subscribers[i:i + IMPORT_BATCH_SIZE]
+            })
+        pipe.hset(self.location_key, mapping=self._location_mapping(
+            inputs["location"]["zip_codes"], inputs["location"]["radius"]
+        ))
+        self._reset(keys=[self.version_key, self.reset_key], client=pipe)
+        version = pipe.execute()[-1]
+        self.logger.info(
+            f"Imported {len(subscribers)} subscribers, version {version}"
+        )
+        return version
+
+    def import_file(self, input_file):
+        with open(input_file) as json_file:
+            return self.import_inputs(json.load(json_file))
+
+    def set_subscribers(self, entries):
+        """
+        Add or update subscribers, entries by phone number in the input
+        file format
+        """
+        pipe = self.connection.pipeline()
+        pipe.hset(self.subscribers_key, mapping={
+            ph: json.dumps(entry) for ph, entry in entries.items()
+        })
+        self._change(
+            keys=[self.version_key, self.changes_key],
+            args=[SUBSCRIBER_FIELD.format(phone_number=ph) for ph in entries],
+            client=pipe,
+        )
+        return pipe.execute()[-1]
+
+    def remove_subscribers(self, phone_numbers):
+        pipe = self.connection.pipeline()
+        pipe.hdel(self.subscribers_key, *phone_numbers)
+        self._change(
+            keys=[self.version_key, self.changes_key],
+            args=[
+                SUBSCRIBER_FIELD.format(phone_number=ph)
+                for ph in phone_numbers
+            ],
+            client=pipe,
+        )
+        return pipe.execute()[-1]
+
+    def set_location(self, zip_codes, radius):
+        pipe = self.connection.pipeline()
+        pipe.hset(
+            self.location_key,
+            mapping=self._location_mapping(zip_codes, radius),
+        )
+        self._change(
+            keys=[self.version_key, self.changes_key], args=[LOCATION_FIELD],
+            client=pipe,
+        )
+        return pipe.execute()[-1]
+
+    @staticmethod
+    def _location_mapping(zip_codes, radius):
+        return {
+            "zip_codes": json.dumps(zip_codes), "radius": json.dumps(radius),
+        }
+
+
+_input_stores = {}
+
+
+def get_input_store(region=DEFAULT_REGION):
+    """
+    Get the process wide input store of a region, shared by all finders of
+    a worker
+    """
+    store = _input_stores.get(region)
+    if store is None:
+        store = _input_stores[region] = InputStore(region=region)
+    return store
+
+
+if __name__ == "__main__":
+    setup_logger()
+    parser = argparse.ArgumentParser(description="Subscribers and location")
+    subparsers = parser.add_subparsers(dest="command")
+    import_ = subparsers.add_parser(
+        "import", help="Replace everything with an input file's contents"
+    )
+    import_.add_argument("input_file")
+    add = subparsers.add_parser("add", help="Add or update a subscriber")
+    add.add_argument("phone_number")
+    add.add_argument("--email")
+    add.add_argument("--zip-code")
+    add.add_argument("--radius", type=float)
+    remove = subparsers.add_parser("remove", help="Remove subscribers")
+    remove.add_argument("phone_numbers", nargs="+")
+    location = subparsers.add_parser("location", help="Set the location")
+    location.add_argument("zip_codes", nargs="+", type=int)
+    location.add_argument("--radius", type=float, required=True)
+    subparsers.add_parser("show", help="Show the version and counts")
+    parser.add_argument("--region", default=DEFAULT_REGION)
+    args = parser.parse_args()
+
+    store = InputStore(region=args.region)
+    if args.command == "import":
+        print(f"Version {store.import_file(args.input_file)}")
+    elif args.command == "add":
+        entry = {"email": args.email}
+        if args.zip_code:
+            entry["zip_code"] = args.zip_code
+        if args.radius:
+            entry["radius"] = args.radius
+        print(f"Version {store.set_subscribers({args.phone_number: entry})}")
+    elif args.command == "remove":
+        print(f"Version {store.remove_subscribers(args.phone_numbers)}")
+    elif args.command == "location":
+        print(f"Version {store.set_location(args.zip_codes, args.radius)}")
+    elif args.command == "show":
+        store.refresh()
+        print(
+            f"Version {store.version}: {len(store.subscribers)} subscribers "
+            f"({len(store.subscriber_locations)} with a location), zip "
+            f"codes {store.zip_codes} within {store.radius} miles"
+        )
+    else:
+        parser.print_help()
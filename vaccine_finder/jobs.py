@@ -1,18 +1,32 @@
 import os
+import time
 import logging
 import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 from vaccine_finder.config import (
-    DEFAULT_INPUT_FILE,
     WINDOW_START,
     WINDOW_END,
     NOTIFY_VACCINE_USERS,
-    DEBUG_VACCINE_FINDER,
+    ALL_CHAINS_DEADLINE,
+    FINDER_TIMEOUT,
+    JOB_TIMEOUT,
+    RITEAID_SHARDS,
+    RITEAID_MIN_SHARD_SIZE,
 )
-from vaccine_finder.riteaid.finder import RiteAidAppointmentFinder
-from vaccine_finder.walgreens.finder import WalgreensAppointmentFinder
-from vaccine_finder.wegmans.finder import WegmansAppointmentFinder
-from vaccine_finder.allentown.finder import AllentownAppointmentFinder
+from rq import Queue, get_current_job
+from rq.job import Job, JobStatus, Dependency
+from rq.exceptions import NoSuchJobError
+
+from vaccine_finder.registry import (
+    FINDERS, get_region_finders, get_notifier,
+)
+from vaccine_finder.notify import record_results
+from vaccine_finder.regions import regions_for
+from vaccine_finder.lease import JobLease
+from vaccine_finder.stats import incr_stat
+from vaccine_finder.profiling import FinderProfile
+from vaccine_finder.metrics import incr_metric, observe_metric, flush_metrics
 
 
 logger = logging.getLogger('Jobs')
@@ -27,60 +41,371 @@ def in_range(t, start=WINDOW_START, end=WINDOW_END):
     return False
 
 
-def _finder_job(finder):
+def _finder_job(finders, run=None):
     """
-    Vaccine Finder Job during time window
+    Vaccine Finder Job during time window, of a chain's finders of every
+    region it serves. Return the run's result. A sampled fraction of runs
+    is profiled, see vaccine_finder.profiling
+
+    run(finders) runs the finders, _leased_find by default
     """
     t = datetime.datetime.now().time()
     logger.info(f"Time: {t}, Window: {WINDOW_START} to {WINDOW_END}")
+    if not finders:
+        logger.info("No region is served by this chain")
+        return None
+    name = type(finders[0]).__name__
 
     if in_range(datetime.datetime.now().time()):
-        finder.find(notify=NOTIFY_VACCINE_USERS)
+        with FinderProfile(name):
+            return (run or _leased_find)(finders)
     else:
-        logger.info(
-            'Not time to run type(finder).__name__ finder. Sleeping ...'
+        logger.info(f'Not time to run {name} finder. Sleeping ...')
+
+
+def _leased_find(finders):
+    """
+    Run a chain's finders of every region, sweeping what they have in
+    common once, unless another run of them is still in flight, in which
+    case the run is skipped and counted
+    """
+    cls = type(finders[0])
+    name = cls.__name__
+    with JobLease(name, ttl=JOB_TIMEOUT) as lease:
+        if not lease.acquired:
+            logger.warning(f"{name} is still running, skipping this run")
+            incr_stat("skipped", name)
+            return {"success": False, "error": None, "skipped": True}
+        return _sweep_result(
+            finders, cls.sweep_regions(finders, notify=NOTIFY_VACCINE_USERS)
         )
 
 
+def _find_result(finder, success):
+    """
+    Summarize a finder run. The adaptive scheduler compares keys between
+    runs to tell whether a chain's availability changed
+    """
+    return {
+        "success": success,
+        "error": finder.last_error,
+        "keys": sorted(finder.last_keys),
+    }
+
+
+def _sweep_result(finders, successes):
+    """
+    Summarize a run of a chain's finders. With several regions keys are
+    prefixed by region and each region's result is kept under regions
+    """
+    if len(finders) == 1:
+        return _find_result(finders[0], successes[0])
+    regions = {
+        finder.region: _find_result(finder, success)
+        for finder, success in zip(finders, successes)
+    }
+    errors = [
+        f"{region}: {result['error']}"
+        for region, result in regions.items() if result["error"]
+    ]
+    return {
+        "success": any(successes),
+        "error": "; ".join(errors) or None,
+        "keys": sorted(
+            f"{region}:{key}"
+            for region, result in regions.items() for key in result["keys"]
+        ),
+        "regions": regions,
+    }
+
+
 def allentown_job():
     """
     Allentown Health Clinic Vaccine Finder Job during time window
     """
-    f = AllentownAppointmentFinder(
-        input_file=DEFAULT_INPUT_FILE,
-        debug=DEBUG_VACCINE_FINDER
-    )
-    _finder_job(f)
+    return _finder_job(get_region_finders("allentown"))
 
 
 def wegmans_job():
     """
     Wegmans Vaccine Finder Job during time window
     """
-    f = WegmansAppointmentFinder(
-        input_file=DEFAULT_INPUT_FILE,
-        debug=DEBUG_VACCINE_FINDER
-    )
-    _finder_job(f)
+    return _finder_job(get_region_finders("wegmans"))
 
 
 def walgreens_job():
     """
     Walgreens Vaccine Finder Job during time window
     """
-    f = WalgreensAppointmentFinder(
-        input_file=DEFAULT_INPUT_FILE,
-        debug=DEBUG_VACCINE_FINDER
+    return _finder_job(get_region_finders("walgreens"))
+
+
+def riteaid_job(shards=RITEAID_SHARDS):
+    """
+    Riteaid Vaccine Finder Job during time window. With more than one
+    shard the sweep is fanned out to sub-jobs, see _fan_out_sweep
+    """
+    job = get_current_job()
+    if shards > 1 and job is not None:
+        return _finder_job(
+            get_region_finders("riteaid"),
+            run=lambda finders: _fan_out_sweep(finders, job, shards),
+        )
+    return _finder_job(get_region_finders("riteaid"))
+
+
+def _split(stores, shards, min_size=RITEAID_MIN_SHARD_SIZE):
+    """
+    Split stores into at most shards chunks of at least min_size stores,
+    sizes differing by at most one
+    """
+    count = max(1, min(shards, len(stores) // max(1, min_size)))
+    size, extra = divmod(len(stores), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(stores[start:end])
+        start = end
+    return chunks
+
+
+def _fan_out_sweep(finders, job, shards):
+    """
+    Split the union of the finders' stores into chunks, check each chunk in
+    its own sub-job and enqueue riteaid_fan_in_job to aggregate them once
+    they all finished or failed. Sweeps too small to split run here
+
+    The finders' lease is held until the fan-in job is done. Return the
+    fan-in job's id, the adaptive scheduler waits for its result
+    """
+    cls = type(finders[0])
+    name = cls.__name__
+    with JobLease(name, ttl=JOB_TIMEOUT) as lease:
+        if not lease.acquired:
+            logger.warning(f"{name} is still running, skipping this run")
+            incr_stat("skipped", name)
+            return {"success": False, "error": None, "skipped": True}
+        try:
+            stores = cls.union_stores(cls.region_stores(finders))
+        except Exception as e:
+            logger.exception(f"Could not get {name} stores: {e}")
+            return {"success": False, "error": repr(e), "keys": []}
+        chunks = _split(stores, shards)
+        if len(chunks) < 2:
+            return _sweep_result(finders, cls.sweep_regions(
+                finders, notify=NOTIFY_VACCINE_USERS
+            ))
+
+        queue = Queue(job.origin, connection=job.connection)
+        shard_jobs = queue.enqueue_many([
+            Queue.prepare_data(
+                riteaid_shard_job, args=(chunk,), timeout=FINDER_TIMEOUT,
+                result_ttl=JOB_TIMEOUT, failure_ttl=JOB_TIMEOUT,
+                description=f"riteaid shard {i + 1}/{len(chunks)}",
+            )
+            for i, chunk in enumerate(chunks)
+        ])
+        fan_in = queue.enqueue(
+            riteaid_fan_in_job,
+            args=([j.id for j in shard_jobs], lease.token, time.time()),
+            depends_on=Dependency(jobs=shard_jobs, allow_failure=True),
+            job_timeout=FINDER_TIMEOUT,
+        )
+        lease.hand_off()
+    logger.info(
+        f"Fanned {len(stores)} {name} stores of {len(finders)} regions out "
+        f"to {len(chunks)} shards, fan-in job {fan_in.id}"
+    )
+    return {"fan_in": fan_in.id, "shards": len(chunks)}
+
+
+def riteaid_shard_job(stores):
+    """
+    Check one chunk of a sharded RiteAid sweep. Return the stores with
+    appointments and how many (errors) and which stores couldn't be checked
+    """
+    start = time.monotonic()
+    finder = get_region_finders("riteaid")[0]
+    stores_with_appts, failed_stores = finder.check_stores(stores)
+    seconds = time.monotonic() - start
+    observe_metric(
+        "sweep_shard_seconds", {"finder": type(finder).__name__}, seconds
+    )
+    flush_metrics()
+    return {
+        "stores": len(stores),
+        "stores_with_appts": stores_with_appts,
+        "failed_stores": failed_stores,
+        "errors": len(failed_stores),
+        "seconds": round(seconds, 2),
+    }
+
+
+def riteaid_fan_in_job(shard_ids, lease_token, started_at):
+    """
+    Aggregate the shards of a RiteAid sweep into one finder run per
+    region, which notifies its subscribers once, and release the sweep's
+    lease
+
+    Shards that failed are reported by chunk in the result's shards and
+    make the run an error. Their stores count as no availability. Stores
+    the shards couldn't check fail their regions' runs
+    """
+    finders = get_region_finders("riteaid")
+    cls = type(finders[0])
+    name = cls.__name__
+    connection = get_current_job().connection
+    shards = []
+    stores_with_appts = []
+    failed_stores = []
+    for i, job_id in enumerate(shard_ids):
+        shard = _shard_result(job_id, connection)
+        stores_with_appts.extend(shard.pop("stores_with_appts", []))
+        failed_stores.extend(shard.pop("failed_stores", []))
+        shards.append(shard)
+        if shard["status"] != "done":
+            logger.error(
+                f"{name} shard {i + 1}/{len(shard_ids)} ({job_id}) "
+                f"{shard['status']}: {shard['error']}"
+            )
+            incr_metric("sweep_shard_failures", {"finder": name})
+
+    try:
+        shared = cls.share_stores(
+            cls.region_stores(finders), stores_with_appts, failed_stores
+        )
+        result = _sweep_result(finders, [
+            finder.find(notify=NOTIFY_VACCINE_USERS, **kwargs)
+            for finder, kwargs in zip(finders, shared)
+        ])
+    finally:
+        JobLease.resume(name, lease_token, ttl=JOB_TIMEOUT).release()
+
+    failed = sum(1 for shard in shards if shard["status"] != "done")
+    errors = sum(shard.get("errors", 0) for shard in shards)
+    if failed and not result["error"]:
+        result["error"] = f"{failed} of {len(shards)} shards failed"
+    elif errors and not result["error"]:
+        stores = sum(shard.get("stores", 0) for shard in shards)
+        result["error"] = f"{errors} of {stores} stores failed"
+    result["shards"] = shards
+    seconds = time.time() - started_at
+    observe_metric("sweep_seconds", {"finder": name}, seconds)
+    flush_metrics()
+    logger.info(
+        f"{name} sweep of {len(shards)} shards finished in {seconds:.2f} "
+        f"seconds, {failed} failed, {errors} stores failed"
     )
-    _finder_job(f)
+    return result
+
+
+def _shard_result(job_id, connection):
+    """
+    Result of a shard job, or its status and error if it didn't finish
+    """
+    try:
+        job = Job.fetch(job_id, connection=connection)
+        status = job.get_status()
+    except NoSuchJobError:
+        return {"status": "missing", "error": "job expired"}
+    if status == JobStatus.FINISHED:
+        return dict(job.return_value(), status="done", error=None)
+    result = job.latest_result()
+    error = None
+    if result is not None and result.exc_string:
+        error = result.exc_string.strip().splitlines()[-1]
+    return {"status": getattr(status, "value", status), "error": error}
+
+
+# Job of each chain in FINDERS, scheduled separately in the separate job mode
+CHAIN_JOBS = {
+    "allentown": allentown_job,
+    "riteaid": riteaid_job,
+    "walgreens": walgreens_job,
+    "wegmans": wegmans_job,
+}
+
+
+def all_chains_job(
+    names=None, deadline=ALL_CHAINS_DEADLINE, finder_timeout=FINDER_TIMEOUT
+):
+    """
+    Run all registered finders serving some region (or the named ones)
+    concurrently during time window and return the aggregated results by
+    finder name
+
+    Every finder gets min(finder_timeout, deadline) seconds from the start
+    of the job. Finders still running then are reported as timed out and
+    left to finish in the background, threads can't be cancelled
+    """
+    t = datetime.datetime.now().time()
+    logger.info(f"Time: {t}, Window: {WINDOW_START} to {WINDOW_END}")
+    if not in_range(t):
+        logger.info("Not time to run all chains finders. Sleeping ...")
+        return {}
+
+    names = names or [name for name in FINDERS if regions_for(name)]
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=len(names))
+    futures = {name: executor.submit(_run_finder, name) for name in names}
+    executor.shutdown(wait=False)
+
+    results = {}
+    end = start + min(finder_timeout, deadline)
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(
+                timeout=max(0, end - time.monotonic())
+            )
+        except TimeoutError:
+            logger.error(f"{name} finder timed out")
+            results[name] = {
+                "status": "timeout", "success": False, "error": "timeout",
+            }
+        except Exception as e:
+            logger.exception(f"{name} finder failed: {e}")
+            results[name] = {
+                "status": "error", "success": False, "error": repr(e),
+            }
+
+    logger.info(
+        f"All chains run finished in {time.monotonic() - start:.2f} "
+        f"seconds: {results}"
+    )
+    return results
+
+
+def _run_finder(name):
+    start = time.monotonic()
+    result = _leased_find(get_region_finders(name))
+    result["status"] = "done"
+    result["seconds"] = round(time.monotonic() - start, 2)
+    return result
+
+
+def riteaid_catalog_job():
+    """
+    Refresh the RiteAid store catalog of every region so finder runs don't
+    call getStores
+    """
+    for f in get_region_finders("riteaid"):
+        f.catalog.refresh(f.zip_codes, f.radius)
 
 
-def riteaid_job():
+def deliver_texts_job(message, phone_numbers):
     """
-    Riteaid Vaccine Finder Job during time window
+    Send a notification's texts and record each recipient's result under
+    the job id
     """
-    f = RiteAidAppointmentFinder(
-        input_file=DEFAULT_INPUT_FILE,
-        debug=DEBUG_VACCINE_FINDER
+    start = datetime.datetime.now()
+    results = get_notifier().send_texts(message, phone_numbers)
+    job = get_current_job()
+    if job:
+        record_results(job.id, results, connection=job.connection)
+    sent = sum(1 for r in results.values() if r["status"] == "sent")
+    logger.info(
+        f"Sent {sent}/{len(results)} texts in "
+        f"{(datetime.datetime.now() - start).total_seconds():.2f} seconds"
     )
-    _finder_job(f)
+    return results
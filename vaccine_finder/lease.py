@@ -0,0 +1,85 @@
+import uuid
+import logging
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import JOB_TIMEOUT
+from vaccine_finder.utils import get_redis_connection
+
+LEASE_KEY = "vaccine_finder:lease:{name}"
+
+# Delete the lease only if we still hold it
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class JobLease(object):
+    """
+    Redis lease that lets only one run of a job be in flight at a time.
+    The lease expires after ttl seconds in case its holder dies
+
+        with JobLease("riteaid_job") as lease:
+            if lease.acquired:
+                ...
+    """
+
+    def __init__(self, name, ttl=JOB_TIMEOUT, connection=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.key = LEASE_KEY.format(name=name)
+        self.ttl = ttl
+        self.connection = connection or get_redis_connection()
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+
+    def acquire(self):
+        """
+        Try to take the lease. If Redis is unavailable the lease is
+        considered acquired so jobs still run
+        """
+        try:
+            self.acquired = bool(self.connection.set(
+                self.key, self.token, nx=True, ex=self.ttl
+            ))
+        except RedisError as err:
+            self.logger.warning(f"Lease {self.name} unavailable: {err}")
+            self.acquired = True
+        return self.acquired
+
+    def release(self):
+        if not self.acquired:
+            return
+        try:
+            self.connection.eval(RELEASE_SCRIPT, 1, self.key, self.token)
+        except RedisError as err:
+            self.logger.warning(f"Could not release lease {self.name}: {err}")
+        self.acquired = False
+
+    def hand_off(self):
+        """
+        Keep holding the lease after this object is done with it, for
+        another job to release with the returned token (see resume)
+        """
+        self.acquired = False
+        return self.token
+
+    @classmethod
+    def resume(cls, name, token, **kwargs):
+        """
+        Take over a lease handed off with its token
+        """
+        lease = cls(name, **kwargs)
+        lease.token = token
+        lease.acquired = True
+        return lease
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,278 @@
+"""
+Request timing and run metrics
+
+Metrics are aggregated in process and added to Redis hashes at most every
+METRICS_FLUSH_INTERVAL seconds (and at the end of finder runs and text
+deliveries), so recording one costs no Redis round trip. Every worker adds
+to the same hashes, which the exporter serves in the Prometheus text format
+
+    python -m vaccine_finder.metrics --port 9100
+"""
+import time
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import (
+    METRICS_ENABLED, METRICS_FLUSH_INTERVAL, METRICS_PORT,
+)
+
+METRICS_KEY = "vaccine_finder:metrics"
+METRIC_KEY = "vaccine_finder:metrics:{name}"
+METRIC_PREFIX = "vaccine_finder_"
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+logger = logging.getLogger(__name__)
+
+
+def label_string(labels):
+    """
+    Prometheus label set, e.g. endpoint="www.riteaid.com/...",status="200"
+    """
+    return ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for k, v in sorted(labels.items())
+    )
+
+
+class Metrics(object):
+    """
+    Thread safe in process counters, gauges and histograms, added to
+    Redis by flush. Fields of a histogram's hash are the label set followed by
+    |le=<bound>, |sum or |count, bucket counts are cumulative
+    """
+
+    def __init__(
+        self, connection=None, flush_interval=METRICS_FLUSH_INTERVAL,
+        enabled=METRICS_ENABLED, buckets=LATENCY_BUCKETS,
+    ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.connection = connection
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.last_flush = time.monotonic()
+
+    def incr(self, name, labels, amount=1):
+        """
+        Add amount to a counter
+        """
+        if not self.enabled:
+            return
+        field = label_string(labels)
+        with self.lock:
+            self.types[name] = "counter"
+            values = self.values.setdefault(name, {})
+            values[field] = values.get(field, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name, labels, value):
+        """
+        Add an observation (seconds) to a histogram
+        """
+        if not self.enabled:
+            return
+        field = label_string(labels)
+        with self.lock:
+            self.types[name] = "histogram"
+            values = self.values.setdefault(name, {})
+            for bound in self.buckets:
+                if value <= bound:
+                    key = f"{field}|le={bound}"
+                    values[key] = values.get(key, 0) + 1
+            values[f"{field}|sum"] = values.get(f"{field}|sum", 0) + value
+            values[f"{field}|count"] = values.get(f"{field}|count", 0) + 1
+        self._maybe_flush()
+
+    def set(self, name, labels, value):
+        """
+        Set a gauge. The last value set by any worker wins
+        """
+        if not self.enabled:
+            return
+        field = label_string(labels)
+        with self.lock:
+            self.types[name] = "gauge"
+            self.values.setdefault(name, {})[field] = value
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the metrics recorded since the last flush to Redis. They are
+        dropped if Redis is unavailable
+        """
+        with self.lock:
+            types, values = self.types, self.values
+            self.types, self.values = {}, {}
+            self.last_flush = time.monotonic()
+        if not values:
+            return
+
+        # utils times its requests with this module, import it lazily
+        from vaccine_finder.utils import get_redis_connection
+        connection = self.connection or get_redis_connection()
+        try:
+            pipe = connection.pipeline(transaction=False)
+            pipe.hset(METRICS_KEY, mapping=types)
+            for name, fields in values.items():
+                key = METRIC_KEY.format(name=name)
+                if types[name] == "gauge":
+                    pipe.hset(key, mapping=fields)
+                    continue
+                for field, value in fields.items():
+                    if isinstance(value, float):
+                        pipe.hincrbyfloat(key, field, value)
+                    else:
+                        pipe.hincrby(key, field, value)
+            pipe.execute()
+        except RedisError as err:
+            self.logger.warning(f"Could not save metrics: {err}")
+
+
+_metrics = Metrics()
+
+
+def incr_metric(name, labels, amount=1):
+    """
+    Add amount to a counter of this process, e.g.
+    incr_metric("texts", {"status": "sent"})
+    """
+    _metrics.incr(name, labels, amount)
+
+
+def observe_metric(name, labels, value):
+    """
+    Add an observation to a histogram of this process, e.g.
+    observe_metric("finder_run_seconds", {"finder": "riteaid"}, 1.5)
+    """
+    _metrics.observe(name, labels, value)
+
+
+def set_metric(name, labels, value):
+    """
+    Set a gauge, e.g. set_metric("circuit_open", {"endpoint": ...}, 1)
+    """
+    _metrics.set(name, labels, value)
+
+
+def flush_metrics():
+    """
+    Add this process' metrics to Redis
+    """
+    _metrics.flush()
+
+
+def render_metrics(connection):
+    """
+    All metrics in Redis in the Prometheus text format, along with the
+    vaccine_finder.stats counters
+    """
+    # Imported here, stats depends on utils
+    from vaccine_finder.stats import STATS_KEY
+
+    lines = []
+    types = {
+        k.decode(): v.decode()
+        for k, v in connection.hgetall(METRICS_KEY).items()
+    }
+    for name, type_ in sorted(types.items()):
+        metric = METRIC_PREFIX + name
+        lines.append(f"# TYPE {metric} {type_}")
+        fields = {
+            k.decode(): v.decode()
+            for k, v in connection.hgetall(
+                METRIC_KEY.format(name=name)
+            ).items()
+        }
+        if type_ == "histogram":
+            lines.extend(_render_histogram(metric, fields))
+        else:
+            for labels, value in sorted(fields.items()):
+                lines.append(_sample(metric, labels, value))
+
+    for key in sorted(connection.scan_iter(STATS_KEY.format(stat="*"))):
+        stat = key.decode().rsplit(":", 1)[-1]
+        metric = f"{METRIC_PREFIX}{stat}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for label, value in sorted(connection.hgetall(key).items()):
+            labels = label_string({"job": label.decode()})
+            lines.append(_sample(metric, labels, value.decode()))
+    return "\n".join(lines) + "\n"
+
+
+def _sample(metric, labels, value):
+    return f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}"
+
+
+def _render_histogram(metric, fields):
+    series = {}
+    for field, value in fields.items():
+        labels, _, suffix = field.rpartition("|")
+        series.setdefault(labels, {})[suffix] = value
+    for labels, values in sorted(series.items()):
+        buckets = sorted(
+            (float(suffix[3:]), suffix[3:], value)
+            for suffix, value in values.items() if suffix.startswith("le=")
+        )
+        buckets.append((None, "+Inf", values.get("count", 0)))
+        for _, bound, value in buckets:
+            le = f'le="{bound}"'
+            yield _sample(
+                f"{metric}_bucket", f"{labels},{le}" if labels else le, value
+            )
+        yield _sample(f"{metric}_sum", labels, values.get("sum", 0))
+        yield _sample(f"{metric}_count", labels, values.get("count", 0))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics(self.server.connection).encode()
+        except RedisError as err:
+            self.send_error(503, f"Redis unavailable: {err}")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(port=METRICS_PORT, connection=None):
+    """
+    Serve the metrics in Redis at http://0.0.0.0:<port>/metrics
+    """
+    from vaccine_finder.utils import get_redis_connection
+
+    httpd = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    httpd.connection = connection or get_redis_connection()
+    logger.info(f"Serving metrics on port {port}")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    from vaccine_finder.utils import setup_logger
+
+    setup_logger()
+    parser = argparse.ArgumentParser(description="Metrics exporter")
+    parser.add_argument("--port", type=int, default=METRICS_PORT)
+    serve(parser.parse_args().port)
@@ -1,38 +1,217 @@
 import os
+import json
+import math
+import time
+import random
 import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint, pformat
+from urllib.parse import urlsplit
 
+import requests
+from rq import Queue
 from twilio.rest import Client
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
 from vaccine_finder.config import (
     TWILIO_ACCOUNT_ID,
     TWILIO_AUTH_TOKEN,
     TWILIO_PHONE_NUMBER,
-
+    TWILIO_API_BASE_URL,
+    NOTIFY_QUEUE,
+    NOTIFY_MAX_WORKERS,
+    NOTIFY_RATE_LIMIT,
+    NOTIFY_TIMEOUT_MARGIN,
+    NOTIFY_MAX_RETRIES,
+    NOTIFY_RESULT_TTL,
+)
+from vaccine_finder.utils import (
+    setup_logger, get_redis_connection, SAMPLED,
+)
+from vaccine_finder.ratelimit import HostRateLimiter
+from vaccine_finder.metrics import (
+    incr_metric, observe_metric, flush_metrics,
 )
-from vaccine_finder.utils import setup_logger
+
+NOTIFICATION_RESULTS_KEY = "vaccine_finder:notifications:{notification_id}"
+TWILIO_HOST = "api.twilio.com"
+# Share of the texts of a delivery job that may be retried within its timeout
+RETRY_ALLOWANCE = 0.5
+
+
+class RedirectingHttpClient(TwilioHttpClient):
+    """
+    Twilio HTTP client that sends every request to base_url instead of
+    api.twilio.com, for running against a local stand-in of the Twilio API
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        url = self.base_url + parts.path
+        if parts.query:
+            url += f"?{parts.query}"
+        return super().request(method, url, *args, **kwargs)
+
+
+def record_results(notification_id, results, connection=None):
+    """
+    Save per recipient delivery results of a notification in Redis
+    """
+    connection = connection or get_redis_connection()
+    key = NOTIFICATION_RESULTS_KEY.format(notification_id=notification_id)
+    connection.hset(
+        key, mapping={ph: json.dumps(r) for ph, r in results.items()}
+    )
+    connection.expire(key, NOTIFY_RESULT_TTL)
+
+
+def get_results(notification_id, connection=None):
+    """
+    Get per recipient delivery results of a notification
+    """
+    connection = connection or get_redis_connection()
+    key = NOTIFICATION_RESULTS_KEY.format(notification_id=notification_id)
+    return {
+        ph.decode(): json.loads(r)
+        for ph, r in connection.hgetall(key).items()
+    }
 
 
 class Notifier(object):
-    def __init__(self, init_logger=False):
+    def __init__(
+        self,
+        init_logger=False,
+        client=None,
+        max_workers=NOTIFY_MAX_WORKERS,
+        rate_limit=NOTIFY_RATE_LIMIT,
+        max_retries=NOTIFY_MAX_RETRIES,
+        connection=None,
+    ):
         if init_logger:
             setup_logger()
         self.logger = logging.getLogger(type(self).__name__)
         account_sid = TWILIO_ACCOUNT_ID
         auth_token = TWILIO_AUTH_TOKEN
         self.twilio_number = TWILIO_PHONE_NUMBER
-        self.client = Client(account_sid, auth_token)
+        self.twilio_host = TWILIO_HOST
+        http_client = None
+        if TWILIO_API_BASE_URL:
+            http_client = RedirectingHttpClient(TWILIO_API_BASE_URL)
+            self.twilio_host = urlsplit(TWILIO_API_BASE_URL).netloc
+        self.client = client or Client(
+            account_sid, auth_token, http_client=http_client
+        )
+        self.max_workers = max(1, max_workers)
+        # Texts are spaced by a token bucket in Redis, shared by every
+        # delivery job, since the Twilio rate limit is per account
+        self.rate_limit = rate_limit
+        self.rate_limiter = HostRateLimiter(
+            connection or get_redis_connection(),
+            rates={self.twilio_host: rate_limit},
+            default_rate=0,
+            burst=1,
+        )
+        self.max_retries = max_retries
 
-    def send_texts(self, message, phone_numbers):
+    def send_text(self, message, phone_number):
         """
-        Send text to list of phone numbers
+        Send text to a phone number, retrying rate limited and server
+        errors with exponential backoff. Return the delivery result
         """
-        for phone_number in phone_numbers:
-            self.logger.info(f"📲 Sending text to {phone_number}")
-            response = self.client.messages.create(
-                body=message,
-                from_=self.twilio_number,
-                to=phone_number,
+        attempt = 0
+        while True:
+            attempt += 1
+            self.rate_limiter.acquire(self.twilio_host)
+            self.logger.info(
+                "📲 Sending text to %s", phone_number, extra=SAMPLED
             )
+            try:
+                response = self.client.messages.create(
+                    body=message,
+                    from_=self.twilio_number,
+                    to=phone_number,
+                )
+                return {
+                    "status": "sent", "sid": response.sid,
+                    "attempts": attempt,
+                }
+            except (
+                TwilioRestException, requests.exceptions.RequestException
+            ) as err:
+                status = getattr(err, "status", None)
+                transient = status is None or status == 429 or status >= 500
+                if not transient or attempt > self.max_retries:
+                    self.logger.error(
+                        f"Failed to send text to {phone_number}: {err}"
+                    )
+                    return {
+                        "status": "failed", "error": str(err),
+                        "attempts": attempt,
+                    }
+                if status == 429:
+                    self.rate_limiter.slow_down(self.twilio_host)
+                delay = (2 ** (attempt - 1)) * (0.5 + random.random())
+                self.logger.warning(
+                    f"Retrying text to {phone_number} in {delay:.1f}s: {err}"
+                )
+                time.sleep(delay)
+
+    def send_texts(self, message, phone_numbers):
+        """
+        Send text to list of phone numbers concurrently. Return the
+        delivery result for each phone number
+
+        Records the texts sent and failed and the time to send them all
+        """
+        phone_numbers = list(phone_numbers)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(zip(phone_numbers, executor.map(
+                lambda ph: self.send_text(message, ph), phone_numbers
+            )))
+        statuses = Counter(r["status"] for r in results.values())
+        for status, count in statuses.items():
+            incr_metric("texts", {"status": status}, count)
+        incr_metric(
+            "text_retries", {},
+            sum(r["attempts"] - 1 for r in results.values())
+        )
+        observe_metric("send_texts_seconds", {}, time.monotonic() - start)
+        flush_metrics()
+        return results
+
+    def delivery_timeout(self, count):
+        """
+        Seconds a delivery job of count texts may run - the time to send
+        them at the rate limit, with room for retries, plus a margin
+        """
+        seconds = 0
+        if self.rate_limit > 0:
+            seconds = count * (1 + RETRY_ALLOWANCE) / self.rate_limit
+        return int(math.ceil(seconds + NOTIFY_TIMEOUT_MARGIN))
+
+    def enqueue_texts(self, message, phone_numbers, queue=None):
+        """
+        Queue texts to be sent by a notification rq job and return the job.
+        The job id identifies the notification's recorded results
+        """
+        phone_numbers = list(phone_numbers)
+        queue = queue or Queue(NOTIFY_QUEUE, connection=get_redis_connection())
+        job = queue.enqueue(
+            "vaccine_finder.jobs.deliver_texts_job",
+            message, phone_numbers,
+            job_timeout=self.delivery_timeout(len(phone_numbers)),
+        )
+        self.logger.info(
+            f"Queued notification {job.id} for {len(phone_numbers)} "
+            "subscribers"
+        )
+        return job
 
     def send_emails(self, message, email_addresses):
         """
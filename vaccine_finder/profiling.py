@@ -0,0 +1,276 @@
+"""
+Opt-in profiling of finder runs
+
+A sampled fraction (PROFILE_SAMPLE_RATE) of runs is profiled with cProfile,
+covering the threads the run starts, and tracemalloc. Profiles are kept in
+Redis by finder class and job id (local-<id> outside of rq jobs)
+
+    python -m vaccine_finder.profiling list
+    python -m vaccine_finder.profiling show <job id> \\
+        --finder RiteAidAppointmentFinder
+    python -m vaccine_finder.profiling diff <job id> <other job id> \\
+        --finder RiteAidAppointmentFinder
+"""
+import json
+import time
+import uuid
+import random
+import marshal
+import pstats
+import cProfile
+import logging
+import argparse
+import threading
+import tracemalloc
+
+from redis.exceptions import RedisError
+from rq import get_current_job
+
+from vaccine_finder.config import (
+    PROFILE_SAMPLE_RATE, PROFILE_TTL, PROFILE_MAX_RUNS, PROFILE_TOP,
+)
+from vaccine_finder.utils import get_redis_connection, setup_logger
+
+PROFILE_KEY = "vaccine_finder:profile:{name}:{job_id}"
+PROFILES_KEY = "vaccine_finder:profiles:{name}"
+# Allocation sites kept from a run's tracemalloc snapshot
+MEMORY_SITES = 100
+
+logger = logging.getLogger(__name__)
+
+
+class FinderProfile(object):
+    """
+    Profile the run inside the with block if it's sampled and save it
+
+        with FinderProfile("RiteAidAppointmentFinder"):
+            finder.find()
+    """
+
+    def __init__(
+        self, name, job_id=None, sample_rate=PROFILE_SAMPLE_RATE,
+        connection=None,
+    ):
+        self.name = name
+        self.job_id = job_id
+        self.sample_rate = sample_rate
+        self.connection = connection
+        self.sampled = False
+        self.profiler = None
+        self.thread_profilers = []
+        self.started_tracemalloc = False
+
+    def _profile_thread(self, frame, event, arg):
+        # Runs once in each thread started during the run, cProfile only
+        # sees the thread it's enabled in
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler, which sees every thread
+            return
+        self.thread_profilers.append(profiler)
+
+    def __enter__(self):
+        self.sampled = random.random() < self.sample_rate
+        if not self.sampled:
+            return self
+        if self.job_id is None:
+            job = get_current_job()
+            self.job_id = job.id if job else f"local-{uuid.uuid4().hex[:8]}"
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.start = time.time()
+        self.profiler = cProfile.Profile()
+        threading.setprofile(self._profile_thread)
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.sampled:
+            return
+        self.profiler.disable()
+        threading.setprofile(None)
+        seconds = time.time() - self.start
+        stats = pstats.Stats(self.profiler)
+        for profiler in self.thread_profilers:
+            stats.add(profiler)
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        memory = [
+            [str(s.traceback), s.size, s.count]
+            for s in snapshot.statistics("lineno")[:MEMORY_SITES]
+        ]
+        save_profile(
+            self.name, self.job_id, stats.stats, memory,
+            {"started_at": self.start, "seconds": seconds, "peak": peak},
+            connection=self.connection,
+        )
+
+
+def save_profile(name, job_id, stats, memory, info, connection=None):
+    """
+    Save a run's cProfile stats, top allocation sites and info in Redis
+    """
+    connection = connection or get_redis_connection()
+    key = PROFILE_KEY.format(name=name, job_id=job_id)
+    index = PROFILES_KEY.format(name=name)
+    try:
+        pipe = connection.pipeline()
+        pipe.hset(key, mapping={
+            "stats": marshal.dumps(stats),
+            "memory": json.dumps(memory),
+            "info": json.dumps(info),
+        })
+        pipe.expire(key, PROFILE_TTL)
+        pipe.zadd(index, {job_id: info["started_at"]})
+        pipe.zremrangebyrank(index, 0, -PROFILE_MAX_RUNS - 1)
+        pipe.expire(index, PROFILE_TTL)
+        pipe.execute()
+    except RedisError as err:
+        logger.warning(f"Could not save profile of {name} {job_id}: {err}")
+        return
+    logger.info(
+        f"Saved profile of {name} {job_id}, {info['seconds']:.2f} seconds"
+    )
+
+
+def load_profile(name, job_id, connection=None):
+    """
+    Get a run's cProfile stats (the pstats.Stats.stats dict), allocation
+    sites and info
+    """
+    connection = connection or get_redis_connection()
+    profile = connection.hgetall(PROFILE_KEY.format(name=name, job_id=job_id))
+    if not profile:
+        raise KeyError(f"No profile of {name} {job_id}")
+    return (
+        marshal.loads(profile[b"stats"]),
+        json.loads(profile[b"memory"]),
+        json.loads(profile[b"info"]),
+    )
+
+
+def list_profiles(connection=None):
+    """
+    Job ids of the saved profiles by finder class, oldest first
+    """
+    connection = connection or get_redis_connection()
+    profiles = {}
+    for key in connection.scan_iter(PROFILES_KEY.format(name="*")):
+        name = key.decode().rsplit(":", 1)[-1]
+        profiles[name] = [
+            (job_id.decode(), started_at)
+            for job_id, started_at in connection.zrange(
+                key, 0, -1, withscores=True
+            )
+        ]
+    return profiles
+
+
+def hot_spots(stats, top=PROFILE_TOP):
+    """
+    Functions with the most own time, as (function, calls, own seconds,
+    cumulative seconds)
+    """
+    rows = [
+        (pstats.func_std_string(func), nc, tt, ct)
+        for func, (cc, nc, tt, ct, callers) in stats.items()
+    ]
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:top]
+
+
+def diff_hot_spots(stats, other, top=PROFILE_TOP):
+    """
+    Functions whose own time changed the most from stats to other, as
+    (function, own seconds, other own seconds)
+    """
+    rows = []
+    for func in set(stats) | set(other):
+        tt = stats[func][2] if func in stats else 0.0
+        other_tt = other[func][2] if func in other else 0.0
+        rows.append((pstats.func_std_string(func), tt, other_tt))
+    rows.sort(key=lambda row: abs(row[2] - row[1]), reverse=True)
+    return rows[:top]
+
+
+def diff_memory(memory, other, top=PROFILE_TOP):
+    """
+    Allocation sites whose size changed the most, as (site, bytes, other
+    bytes)
+    """
+    sizes = {site: size for site, size, count in memory}
+    other_sizes = {site: size for site, size, count in other}
+    rows = [
+        (site, sizes.get(site, 0), other_sizes.get(site, 0))
+        for site in set(sizes) | set(other_sizes)
+    ]
+    rows.sort(key=lambda row: abs(row[2] - row[1]), reverse=True)
+    return rows[:top]
+
+
+def _print_info(job_id, info):
+    print(
+        f"{job_id}: {info['seconds']:.2f} seconds, peak traced memory "
+        f"{info['peak'] / 1024:.0f} KiB"
+    )
+
+
+if __name__ == "__main__":
+    setup_logger()
+    parser = argparse.ArgumentParser(description="Finder run profiles")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="List saved profiles")
+    show = subparsers.add_parser("show", help="Show a run's hot spots")
+    show.add_argument("job_id")
+    diff = subparsers.add_parser("diff", help="Diff two runs' hot spots")
+    diff.add_argument("job_id")
+    diff.add_argument("other_job_id")
+    for subparser in (show, diff):
+        subparser.add_argument(
+            "--finder", dest="name", required=True,
+            help="Finder class, e.g. RiteAidAppointmentFinder"
+        )
+        subparser.add_argument("--top", type=int, default=PROFILE_TOP)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for name, runs in sorted(list_profiles().items()):
+            print(name)
+            for job_id, started_at in runs:
+                print(f"  {job_id}  {time.ctime(started_at)}")
+    elif args.command == "show":
+        stats, memory, info = load_profile(args.name, args.job_id)
+        _print_info(args.job_id, info)
+        print(f"\n{'calls':>9} {'own s':>9} {'cum s':>9}  function")
+        for func, nc, tt, ct in hot_spots(stats, args.top):
+            print(f"{nc:>9} {tt:>9.3f} {ct:>9.3f}  {func}")
+        print(f"\n{'KiB':>9} {'blocks':>9}  allocation site")
+        for site, size, count in memory[:args.top]:
+            print(f"{size / 1024:>9.1f} {count:>9}  {site}")
+    elif args.command == "diff":
+        stats, memory, info = load_profile(args.name, args.job_id)
+        other, other_memory, other_info = load_profile(
+            args.name, args.other_job_id
+        )
+        _print_info(args.job_id, info)
+        _print_info(args.other_job_id, other_info)
+        print(f"\n{'own s':>9} {'other s':>9} {'change':>9}  function")
+        for func, tt, other_tt in diff_hot_spots(stats, other, args.top):
+            print(
+                f"{tt:>9.3f} {other_tt:>9.3f} {other_tt - tt:>+9.3f}  {func}"
+            )
+        print(f"\n{'KiB':>9} {'other':>9} {'change':>9}  allocation site")
+        for site, size, other_size in diff_memory(
+            memory, other_memory, args.top
+        ):
+            print(
+                f"{size / 1024:>9.1f} {other_size / 1024:>9.1f} "
+                f"{(other_size - size) / 1024:>+9.1f}  {site}"
+            )
+    else:
+        parser.print_help()
@@ -0,0 +1,169 @@
+import time
+import logging
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import (
+    RATE_LIMITS,
+    RATE_LIMIT_DEFAULT,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_MIN_FACTOR,
+    RATE_LIMIT_RECOVERY,
+)
+
+BUCKET_KEY = "vaccine_finder:ratelimit:{host}"
+# Status codes upstreams throttle with
+SLOW_DOWN_STATUSES = (429, 503)
+# Throttled responses within this many seconds of a slow-down count as one
+SLOW_DOWN_WINDOW = 1.0
+BUCKET_TTL = 3600
+
+# Refill the bucket of KEYS[1] up to ARGV[3] (now). The rate factor
+# recovers toward 1 by ARGV[5] per second since the last call
+REFILL = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local min_factor = tonumber(ARGV[4])
+local recovery = tonumber(ARGV[5])
+local bucket = redis.call("hmget", KEYS[1], "tokens", "ts", "factor")
+local ts = tonumber(bucket[2]) or now
+local elapsed = math.max(0, now - ts)
+local factor = math.min(1, (tonumber(bucket[3]) or 1) + elapsed * recovery)
+factor = math.max(min_factor, factor)
+local tokens = tonumber(bucket[1]) or burst
+tokens = math.min(burst, tokens + elapsed * rate * factor)
+"""
+
+# Take a token and return how many seconds the caller has to wait for it.
+# Tokens go negative, so concurrent callers queue up behind each other
+ACQUIRE_SCRIPT = REFILL + """
+tokens = tokens - 1
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / (rate * factor)
+end
+redis.call("hset", KEYS[1], "tokens", tokens, "ts", now, "factor", factor)
+redis.call("expire", KEYS[1], ARGV[6])
+return tostring(wait)
+"""
+
+# Cut the rate factor by ARGV[6] (once per ARGV[8] seconds) and hold
+# requests back for ARGV[7] seconds (Retry-After). Return the new factor
+SLOW_DOWN_SCRIPT = REFILL + """
+local slowed = tonumber(redis.call("hget", KEYS[1], "slowed") or 0)
+if now - slowed >= tonumber(ARGV[8]) then
+    factor = math.max(min_factor, factor * tonumber(ARGV[6]))
+    slowed = now
+end
+local pause = tonumber(ARGV[7])
+if pause > 0 then
+    tokens = math.min(tokens, -pause * rate * factor)
+end
+redis.call(
+    "hset", KEYS[1], "tokens", tokens, "ts", now, "factor", factor,
+    "slowed", slowed
+)
+redis.call("expire", KEYS[1], ARGV[9])
+return tostring(factor)
+"""
+
+
+def parse_rate_limits(value):
+    """
+    Parse host rates, e.g. "www.riteaid.com=20,www.walgreens.com=5", into
+    a dict of requests per second by host
+    """
+    rates = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        host, _, rate = item.partition("=")
+        rates[host.strip().lower()] = float(rate)
+    return rates
+
+
+class HostRateLimiter(object):
+    """
+    Token bucket per upstream host, kept in Redis so it's shared by every
+    worker. Hosts without a rate (and with a default rate of 0) aren't
+    limited and cost no Redis call
+
+    Throttled responses (429, 503) cut the host's rate in half, down to
+    min_factor of it, and it recovers by recovery of the configured rate
+    per second. If Redis is unavailable requests aren't limited
+    """
+
+    def __init__(
+        self,
+        connection,
+        rates=None,
+        default_rate=RATE_LIMIT_DEFAULT,
+        burst=RATE_LIMIT_BURST,
+        min_factor=RATE_LIMIT_MIN_FACTOR,
+        recovery=RATE_LIMIT_RECOVERY,
+        decrease=0.5,
+    ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.connection = connection
+        self.rates = (
+            parse_rate_limits(RATE_LIMITS) if rates is None else rates
+        )
+        self.default_rate = default_rate
+        self.burst = max(1, burst)
+        self.min_factor = min_factor
+        self.recovery = recovery
+        self.decrease = decrease
+        self._acquire = connection.register_script(ACQUIRE_SCRIPT)
+        self._slow_down = connection.register_script(SLOW_DOWN_SCRIPT)
+
+    def rate(self, host):
+        return self.rates.get(host.lower(), self.default_rate)
+
+    def _args(self, host):
+        return [
+            self.rate(host), self.burst, time.time(), self.min_factor,
+            self.recovery,
+        ]
+
+    def acquire(self, host):
+        """
+        Wait for a token of host's bucket. Return the seconds waited
+        """
+        if self.rate(host) <= 0:
+            return 0
+        try:
+            wait = float(self._acquire(
+                keys=[BUCKET_KEY.format(host=host)],
+                args=self._args(host) + [BUCKET_TTL],
+            ))
+        except RedisError as err:
+            self.logger.warning(f"Rate limit of {host} unavailable: {err}")
+            return 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self, host, retry_after=None):
+        """
+        Slow requests to host down after it throttled one, holding them
+        back for retry_after seconds if given. Return the new rate factor
+        """
+        if self.rate(host) <= 0:
+            return None
+        try:
+            factor = float(self._slow_down(
+                keys=[BUCKET_KEY.format(host=host)],
+                args=self._args(host) + [
+                    self.decrease, retry_after or 0, SLOW_DOWN_WINDOW,
+                    BUCKET_TTL,
+                ],
+            ))
+        except RedisError as err:
+            self.logger.warning(f"Could not slow down {host}: {err}")
+            return None
+        self.logger.warning(
+            f"{host} is throttling, slowing down to "
+            f"{self.rate(host) * factor:.2f} requests per second"
+        )
+        return factor
@@ -0,0 +1,73 @@
+"""
+Region profiles served by one deployment
+
+Each region has its own inputs (zip codes, radius and subscribers) and the
+chains it's served by. Regions are read from the JSON file at
+VACCINE_FINDER_REGIONS_FILE, input files relative to it:
+
+    {
+        "philadelphia": {"input_file": "philadelphia.inputs.json"},
+        "lehigh": {
+            "input_file": "lehigh.inputs.json",
+            "chains": ["riteaid", "allentown"]
+        }
+    }
+
+Regions without chains are served by every chain. Without a regions file
+the deployment is one region, default, with the input file at
+VACCINE_FINDER_INPUT_FILE
+"""
+import os
+import json
+from collections import namedtuple
+
+from vaccine_finder.config import DEFAULT_INPUT_FILE, REGIONS_FILE
+
+DEFAULT_REGION = "default"
+
+# chains is None if every chain serves the region
+Region = namedtuple("Region", ["name", "input_file", "chains"])
+
+_regions = None
+
+
+def load_regions(regions_file=REGIONS_FILE):
+    """
+    Read the region profiles by name
+    """
+    if not regions_file:
+        return {
+            DEFAULT_REGION: Region(DEFAULT_REGION, DEFAULT_INPUT_FILE, None)
+        }
+
+    with open(regions_file) as json_file:
+        profiles = json.load(json_file)
+    root = os.path.dirname(os.path.abspath(regions_file))
+    return {
+        name: Region(
+            name,
+            os.path.join(root, profile["input_file"]),
+            profile.get("chains"),
+        )
+        for name, profile in profiles.items()
+    }
+
+
+def get_regions():
+    """
+    Get the region profiles by name, read once per process
+    """
+    global _regions
+    if _regions is None:
+        _regions = load_regions()
+    return _regions
+
+
+def regions_for(chain):
+    """
+    Names of the regions served by chain
+    """
+    return [
+        region.name for region in get_regions().values()
+        if region.chains is None or chain in region.chains
+    ]
@@ -0,0 +1,71 @@
+import logging
+
+from vaccine_finder.config import DEBUG_VACCINE_FINDER
+from vaccine_finder.riteaid.finder import RiteAidAppointmentFinder
+from vaccine_finder.walgreens.finder import WalgreensAppointmentFinder
+from vaccine_finder.wegmans.finder import WegmansAppointmentFinder
+from vaccine_finder.allentown.finder import AllentownAppointmentFinder
+from vaccine_finder.notify import Notifier
+from vaccine_finder.regions import DEFAULT_REGION, get_regions, regions_for
+
+FINDERS = {
+    "allentown": AllentownAppointmentFinder,
+    "riteaid": RiteAidAppointmentFinder,
+    "walgreens": WalgreensAppointmentFinder,
+    "wegmans": WegmansAppointmentFinder,
+}
+
+logger = logging.getLogger(__name__)
+
+# Finders built by this worker process by name and region, reused across
+# jobs. Needs a non-forking rq worker (rq.worker.SimpleWorker) to outlive a
+# single job
+_finders = {}
+_notifier = None
+
+
+def get_finder(name, region=DEFAULT_REGION):
+    """
+    Get this process' finder by name and region, building it on first use.
+    Reused finders keep their HTTP session (and its keep-alive
+    connections), Twilio client and caches, and only re-read inputs that
+    changed
+    """
+    finder = _finders.get((name, region))
+    if finder is None:
+        logger.info(f"Building {name} finder of region {region}")
+        finder = FINDERS[name](
+            input_file=get_regions()[region].input_file,
+            debug=DEBUG_VACCINE_FINDER,
+            region=region,
+        )
+        _finders[(name, region)] = finder
+    else:
+        finder.reload_inputs()
+    return finder
+
+
+def get_region_finders(name):
+    """
+    Get this process' finders by name of every region the chain serves
+    """
+    return [get_finder(name, region) for region in regions_for(name)]
+
+
+def get_notifier():
+    """
+    Get this process' notifier, building it on first use
+    """
+    global _notifier
+    if _notifier is None:
+        _notifier = Notifier()
+    return _notifier
+
+
+def clear_finders():
+    """
+    Drop all finders built by this process
+    """
+    for finder in _finders.values():
+        finder.session.close()
+    _finders.clear()
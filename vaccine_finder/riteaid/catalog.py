@@ -0,0 +1,97 @@
+import json
+import logging
+
+import requests
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import STORE_CATALOG_TTL
+from vaccine_finder.utils import get_redis_connection
+
+STORE_CATALOG_KEY = "vaccine_finder:riteaid:stores:{zip_code}:{radius}"
+
+
+def compact_store(store):
+    """
+    Reduce a getStores store payload to the fields the finder uses
+    """
+    return {
+        "storeNumber": store["storeNumber"],
+        "fullAddress": (
+            f'{store["address"]} {store["city"]}, {store["state"]} '
+            f'{store["zipcode"]}'
+        ),
+        "latitude": store.get("latitude"),
+        "longitude": store.get("longitude"),
+    }
+
+
+class StoreCatalog(object):
+    """
+    Redis backed cache of the vaccine offering RiteAid stores near each zip
+    code. Entries expire after ttl seconds and are kept warm by the
+    riteaid_catalog_job so finder runs normally never call getStores.
+    """
+
+    def __init__(self, fetch_stores, connection=None, ttl=STORE_CATALOG_TTL):
+        """
+        fetch_stores(zip_code, radius) must return the raw getStores list
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.fetch_stores = fetch_stores
+        self.connection = connection or get_redis_connection()
+        self.ttl = ttl
+
+    def get_stores(self, zip_codes, radius):
+        """
+        Get compact store records for all zip codes, merged by store number
+        """
+        stores = {}
+        for zip_code in zip_codes:
+            for store in self._get_zip_stores(zip_code, radius):
+                stores[store["storeNumber"]] = store
+        return list(stores.values())
+
+    def refresh(self, zip_codes, radius):
+        """
+        Re-fetch and cache the stores for all zip codes
+        """
+        for zip_code in zip_codes:
+            try:
+                self._refresh_zip_stores(zip_code, radius)
+            except requests.exceptions.RequestException as err:
+                self.logger.error(
+                    f"Error refreshing stores in zip code {zip_code}: {err}"
+                )
+
+    def _get_zip_stores(self, zip_code, radius):
+        key = STORE_CATALOG_KEY.format(zip_code=zip_code, radius=radius)
+        try:
+            cached = self.connection.get(key)
+        except RedisError as err:
+            self.logger.warning(f"Store catalog unavailable: {err}")
+            cached = None
+        if cached is not None:
+            return json.loads(cached)
+
+        self.logger.info(
+            f"Store catalog miss for zip code {zip_code}, radius {radius}"
+        )
+        try:
+            return self._refresh_zip_stores(zip_code, radius)
+        except requests.exceptions.RequestException as err:
+            self.logger.error(
+                f"Error getting available stores in zip code {zip_code}: "
+                f"{err}"
+            )
+            return []
+
+    def _refresh_zip_stores(self, zip_code, radius):
+        stores = [
+            compact_store(s) for s in self.fetch_stores(zip_code, radius)
+        ]
+        key = STORE_CATALOG_KEY.format(zip_code=zip_code, radius=radius)
+        try:
+            self.connection.set(key, json.dumps(stores), ex=self.ttl)
+        except RedisError as err:
+            self.logger.warning(f"Could not cache stores: {err}")
+        return stores
@@ -1,13 +1,22 @@
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint, pformat
 import logging
 import requests
 
-from vaccine_finder.config import DEFAULT_INPUT_FILE
-from vaccine_finder.utils import setup_logger, send_request
+from vaccine_finder.config import DEFAULT_INPUT_FILE, RITEAID_MAX_WORKERS
+from vaccine_finder.utils import (
+    setup_logger, send_request, LazyFormat, SAMPLED,
+)
 from vaccine_finder.notify import Notifier
 from vaccine_finder.base import BaseAppointmentFinder
+from vaccine_finder.regions import DEFAULT_REGION
+from vaccine_finder.profiling import FinderProfile
+from vaccine_finder.riteaid.catalog import StoreCatalog
+from vaccine_finder.cache import AvailabilityCache
+from vaccine_finder.subscribers import OpeningLocation
 
 CHECK_SLOTS_ENDPOINT = (
     "https://www.riteaid.com/services/ext/v2/vaccine/checkSlots"
@@ -24,58 +33,192 @@ class RiteAidAppointmentFinder(BaseAppointmentFinder):
         debug=False,
         input_file=DEFAULT_INPUT_FILE,
         cookie_dict=None,
+        region=DEFAULT_REGION,
+        max_workers=RITEAID_MAX_WORKERS,
     ):
         super().__init__(
             STORE_LABEL, SCHEDULER_ENDPOINT,
-            debug=debug, input_file=input_file, cookie_dict=cookie_dict
+            debug=debug, input_file=input_file, cookie_dict=cookie_dict,
+            region=region,
+        )
+        # Max number of checkSlots requests in flight at once
+        self.max_workers = max(1, max_workers)
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_maxsize=self.max_workers)
         )
+        self.catalog = StoreCatalog(self._fetch_stores)
+        # checkSlots responses by store number, shared by all workers
+        self.availability_cache = AvailabilityCache("riteaid")
+        # Numbers of the stores the last run couldn't check
+        self.failed_stores = []
 
-    def _find(self, zip_codes=None, radius=None):
+    def _find(
+        self, zip_codes=None, radius=None, stores_with_appts=None,
+        failed_stores=None, store_count=None,
+    ):
         """
         Entrypoint for find script
 
-        Find RiteAids where there are available covid vaccine appointments
+        Find RiteAids where there are available covid vaccine appointments.
+        stores_with_appts, failed_stores (numbers of the stores that
+        couldn't be checked) and store_count skip the sweep, for runs that
+        only aggregate the results of sharded or multi-region sweeps (see
+        jobs.riteaid_job). Stores that couldn't be checked set last_error
         """
         self.zip_codes = zip_codes or self.zip_codes
         self.radius = radius or self.radius
 
+        if stores_with_appts is not None:
+            self.stores_with_appts = stores_with_appts
+            self._record_failed_stores(failed_stores, store_count)
+            return len(self.stores_with_appts) > 0
+
         self.logger.info("Starting vaccine finder ...")
 
         # Get list of stores to query
         stores = self._get_stores(self.zip_codes, self.radius)
+        self.stores_with_appts, failed_stores = self.check_stores(stores)
+        self._record_failed_stores(failed_stores, len(stores))
 
-        self.stores_with_appts = []
-        for store in stores:
-            store["fullAddress"] = (
-                f'{store["address"]} {store["city"]}, {store["state"]} '
-                f'{store["zipcode"]}'
-            )
-            self.logger.info(
-                f"Checking RiteAid {store['storeNumber']} at "
-                f"{store['fullAddress']}"
-            )
+        return len(self.stores_with_appts) > 0
+
+    def _record_failed_stores(self, failed_stores, total):
+        """
+        Fail the run with how many of the total stores couldn't be
+        checked, if any
+        """
+        self.failed_stores = failed_stores or []
+        if not failed_stores:
+            return
+        self.last_error = f"{len(failed_stores)} of {total} stores failed"
+        self.logger.error(f"Incomplete sweep, {self.last_error}")
+
+    def check_stores(self, stores):
+        """
+        Check stores concurrently, at most max_workers at a time. Return
+        the stores with appointments and the numbers of the stores that
+        couldn't be checked
+        """
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._check_store, stores))
+        failed_stores = [
+            store["storeNumber"]
+            for store, avail in zip(stores, results) if avail is None
+        ]
+        self.logger.info(
+            f"Checked {len(stores)} stores in {time.time() - start:.2f} "
+            f"seconds with {self.max_workers} workers, "
+            f"{len(failed_stores)} errors"
+        )
+        stores_with_appts = [
+            store for store, avail in zip(stores, results) if avail
+        ]
+        return stores_with_appts, failed_stores
+
+    @classmethod
+    def _sweep_shared(cls, finders):
+        """
+        Check the union of the regions' stores once, each region gets the
+        stores with appointments among its own
+        """
+        region_stores = cls.region_stores(finders)
+        stores = cls.union_stores(region_stores)
+        finders[0].logger.info(
+            f"Checking {len(stores)} stores for {len(finders)} regions "
+            f"with {sum(len(s) for s in region_stores)} stores in total"
+        )
+        stores_with_appts, failed_stores = finders[0].check_stores(stores)
+        return cls.share_stores(
+            region_stores, stores_with_appts, failed_stores
+        )
+
+    @staticmethod
+    def region_stores(finders):
+        """
+        Each finder's stores, in its region's zip codes and radius
+        """
+        return [
+            finder._get_stores(finder.zip_codes, finder.radius)
+            for finder in finders
+        ]
+
+    @staticmethod
+    def union_stores(region_stores):
+        """
+        The distinct stores of all regions
+        """
+        stores = {}
+        for region in region_stores:
+            for store in region:
+                stores[store["storeNumber"]] = store
+        return list(stores.values())
+
+    @staticmethod
+    def share_stores(region_stores, stores_with_appts, failed_stores=()):
+        """
+        Each region's _find kwargs with its stores with appointments, the
+        numbers of its stores that couldn't be checked and its store count
+        """
+        available = {store["storeNumber"] for store in stores_with_appts}
+        failed = set(failed_stores)
+        return [
+            {
+                "stores_with_appts": [
+                    store for store in stores
+                    if store["storeNumber"] in available
+                ],
+                "failed_stores": [
+                    store["storeNumber"] for store in stores
+                    if store["storeNumber"] in failed
+                ],
+                "store_count": len(stores),
+            }
+            for stores in region_stores
+        ]
+
+    def _check_store(self, store):
+        """
+        Check one RiteAid store for open appointments. Errors are logged
+        and return None, counted as no availability so one bad store
+        doesn't fail the run
+        """
+        self.logger.info(
+            "Checking RiteAid %s at %s",
+            store["storeNumber"], store["fullAddress"], extra=SAMPLED
+        )
 
-            # Send request
-            try:
-                content = send_request(
+        # Send request
+        try:
+            content = self.availability_cache.get(
+                store["storeNumber"],
+                lambda: send_request(
                     self.session,
                     "get",
                     CHECK_SLOTS_ENDPOINT,
                     params={"storeNumber": store["storeNumber"]},
-                )
-            except requests.exceptions.RequestException as err:
-                self.logger.error(
-                    f"Error checking RiteAid {store['storeNumber']}: {err}"
-                )
-
-            self.logger.info(f"Received response:\n{pformat(content)}")
+                ),
+            )
+        except requests.exceptions.RequestException as err:
+            self.logger.error(
+                f"Error checking RiteAid {store['storeNumber']}: {err}"
+            )
+            return None
 
-            # Check availability - for vaccine dose 1/2
-            avail = self._check_availability(content, store)
-            if avail:
-                self.stores_with_appts.append(store)
+        self.logger.debug(
+            "Received response:\n%s", LazyFormat(pformat, content)
+        )
 
-        return len(self.stores_with_appts) > 0
+        # Check availability - for vaccine dose 1/2
+        try:
+            return self._check_availability(content, store)
+        except (KeyError, TypeError, AttributeError) as err:
+            self.logger.error(
+                f"Unexpected response from RiteAid {store['storeNumber']}: "
+                f"{err!r}"
+            )
+            return None
 
     def _notification_message(self):
         """
@@ -89,6 +232,35 @@ class RiteAidAppointmentFinder(BaseAppointmentFinder):
             ]
         )
 
+    def _opening_locations(self):
+        """
+        Stores with appointments, or None if some have no coordinates
+        """
+        locations = []
+        for store in self.stores_with_appts:
+            if store.get("latitude") is None or store.get("longitude") is None:
+                return None
+            locations.append(OpeningLocation(
+                str(store["storeNumber"]),
+                f"Store #{store['storeNumber']} at {store['fullAddress']}",
+                float(store["latitude"]), float(store["longitude"]), 0,
+            ))
+        return locations
+
+    def _availability_keys(self):
+        """
+        Store numbers of stores with appointments
+        """
+        return {
+            str(store["storeNumber"]) for store in self.stores_with_appts
+        }
+
+    def _unchecked_keys(self):
+        """
+        Store numbers of stores that couldn't be checked
+        """
+        return {str(store_number) for store_number in self.failed_stores}
+
     def _check_availability(self, content, store):
         """
         Check if either vaccine dose 1 or 2 have open appointments
@@ -106,42 +278,47 @@ class RiteAidAppointmentFinder(BaseAppointmentFinder):
                 )
             else:
                 self.logger.info(
-                    f"❌ Vaccine dose {vaccine_dose} not available at RiteAid "
-                    f"{store['storeNumber']} {store['fullAddress']}"
+                    "❌ Vaccine dose %s not available at RiteAid %s %s",
+                    vaccine_dose, store["storeNumber"], store["fullAddress"],
+                    extra=SAMPLED
                 )
         return success
 
     def _get_stores(self, zip_codes, radius):
         """
-        Get list of RiteAid stores in zip code within radius
+        Get list of RiteAid stores in zip codes within radius from the
+        store catalog
         """
-        stores = {}
-        for zip_code in zip_codes:
-            params = {
-                "address": zip_code,
-                "radius": radius,
-                # Only get stores offering vaccines
-                "attrFilter": "PREF-112",
-                "fetchMechanismVersion": 2,
-            }
-            # Send request
-            try:
-                content = send_request(
-                    self.session, "get", GET_STORES_ENDPOINT, params=params
-                )
-            except requests.exceptions.RequestException as err:
-                self.logger.error(f"Error getting available stores: {err}")
+        stores = self.catalog.get_stores(zip_codes, radius)
+        self.logger.info(
+            f"Found {len(stores)} stores in zip codes {zip_codes} within "
+            f"radius {radius} miles"
+        )
+        return stores
 
-            stores.update(
-                {s["address"]: s for s in content["Data"]["stores"]}
-            )
-            self.logger.info(
-                f"Found {len(stores)} stores in zip code {zip_code} within "
-                f"radius {radius} miles"
-            )
-        return stores.values()
+    def _fetch_stores(self, zip_code, radius):
+        """
+        Request list of RiteAid stores in zip code within radius
+        """
+        params = {
+            "address": zip_code,
+            "radius": radius,
+            # Only get stores offering vaccines
+            "attrFilter": "PREF-112",
+            "fetchMechanismVersion": 2,
+        }
+        content = send_request(
+            self.session, "get", GET_STORES_ENDPOINT, params=params
+        )
+        stores = content["Data"]["stores"]
+        self.logger.info(
+            f"Found {len(stores)} stores in zip code {zip_code} within "
+            f"radius {radius} miles"
+        )
+        return stores
 
 
 if __name__ == "__main__":
     f = RiteAidAppointmentFinder(debug=True)
-    success = f.find(notify=False)
+    with FinderProfile(type(f).__name__):
+        success = f.find(notify=False)
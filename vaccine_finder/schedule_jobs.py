@@ -1,5 +1,4 @@
 import os
-import time
 from datetime import datetime
 
 from redis import Redis
@@ -7,19 +6,33 @@ from rq import Queue
 from rq_scheduler import Scheduler
 
 from vaccine_finder.config import (
-    JOB_INTERVAL, REDIS_HOST, REDIS_PORT,
+    REDIS_HOST, REDIS_PORT, STORE_CATALOG_REFRESH_INTERVAL, JOB_MODE,
+    INPUT_SOURCE,
 )
-from vaccine_finder.jobs import allentown_job
-from vaccine_finder.jobs import riteaid_job
-from vaccine_finder.jobs import wegmans_job
+from vaccine_finder.jobs import CHAIN_JOBS
+from vaccine_finder.jobs import riteaid_catalog_job
+from vaccine_finder.jobs import all_chains_job
+from vaccine_finder.registry import FINDERS
+from vaccine_finder.scheduler import AdaptiveScheduler
+from vaccine_finder.inputs import InputStore
+from vaccine_finder.regions import get_regions, regions_for
 
-JOBS = [allentown_job, riteaid_job, wegmans_job]
+if JOB_MODE == "combined":
+    JOBS = [all_chains_job]
+else:
+    # Jobs of the chains some region is served by. Each job sweeps the
+    # union of its regions' stores once and notifies every region
+    JOBS = [CHAIN_JOBS[chain] for chain in FINDERS if regions_for(chain)]
+# Background jobs that keep caches warm, with their intervals
+MAINTENANCE_JOBS = [
+    (riteaid_catalog_job, STORE_CATALOG_REFRESH_INTERVAL),
+]
 
 
 def schedule_jobs():
     """
-    Schedule vaccine finding jobs. Then start counter to inform time
-    until next job
+    Schedule background jobs with rq-scheduler. Then run the adaptive
+    scheduler that enqueues the vaccine finding jobs
     """
     conn = Redis(host=REDIS_HOST, port=REDIS_PORT)
     scheduler = Scheduler(connection=conn)
@@ -32,34 +45,32 @@ def schedule_jobs():
         job.cancel()
     queue.delete(delete_jobs=True)
 
+    # Seed each region's input store from its input file the first time
+    if INPUT_SOURCE == "redis":
+        for region in get_regions().values():
+            store = InputStore(connection=conn, region=region.name)
+            if not store.refresh() and os.path.exists(region.input_file):
+                print(
+                    f"Importing {region.name} inputs from "
+                    f"{region.input_file} ..."
+                )
+                store.import_file(region.input_file)
+
     # Schedule jobs
-    for job in JOBS:
+    for job, interval in MAINTENANCE_JOBS:
         print(f"Scheduling {job.__name__} job ...")
         scheduler.schedule(
             id=job.__name__,
             scheduled_time=datetime.now(),
             func=job,
-            interval=JOB_INTERVAL,
+            interval=interval,
             repeat=None,
         )
 
-
-def counter():
-    """
-    Count down until next job is queued
-    """
-    time_delta = 5
-    t = 0
-    while True:
-        print(f"Time until next job queues: {JOB_INTERVAL - t} seconds")
-        time.sleep(time_delta)
-        t += time_delta
-        if t >= JOB_INTERVAL:
-            t = 0
-            print("Queueing job now ...")
+    print(f"Starting adaptive scheduler for {[j.__name__ for j in JOBS]} ...")
+    AdaptiveScheduler(queue, JOBS).run()
 
 
 if __name__ == "__main__":
     print("Scheduling vaccine finder jobs ...")
     schedule_jobs()
-    counter()
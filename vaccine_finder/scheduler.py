@@ -0,0 +1,205 @@
+import time
+import random
+import logging
+import datetime
+
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+
+from vaccine_finder.config import (
+    WINDOW_START,
+    WINDOW_END,
+    JOB_INTERVAL,
+    ADAPTIVE_MIN_INTERVAL,
+    ADAPTIVE_MAX_INTERVAL,
+    ADAPTIVE_JITTER,
+    SCHEDULER_TICK,
+    JOB_TIMEOUT,
+    MAX_QUEUE_DEPTH,
+)
+from vaccine_finder.jobs import in_range
+from vaccine_finder.stats import incr_stat
+
+
+class ChainSchedule(object):
+    """
+    Polling interval of one chain's job
+
+    The interval drops to min_interval when the chain's results change,
+    doubles back toward base_interval while they stay the same and backs
+    off exponentially past it, up to max_interval, on errors
+    """
+
+    def __init__(
+        self,
+        func,
+        base_interval=JOB_INTERVAL,
+        min_interval=ADAPTIVE_MIN_INTERVAL,
+        max_interval=ADAPTIVE_MAX_INTERVAL,
+        jitter=ADAPTIVE_JITTER,
+    ):
+        self.func = func
+        self.name = func.__name__
+        self.base_interval = base_interval
+        self.min_interval = min(min_interval, base_interval)
+        self.max_interval = max(max_interval, base_interval)
+        self.jitter = jitter
+        self.interval = base_interval
+        self.errors = 0
+        self.last_keys = None
+        self.next_run = 0
+        self.job_id = None
+        # Whether the current due run was already counted as held back
+        self.held_back = False
+
+    def record(self, result, failed=False):
+        """
+        Update the interval from a finished job's result
+        """
+        error, keys = self._summarize(result, failed)
+        if error:
+            self.errors += 1
+            self.interval = min(
+                self.max_interval, self.base_interval * 2 ** self.errors
+            )
+        elif self.last_keys is not None and keys != self.last_keys:
+            self.errors = 0
+            self.interval = self.min_interval
+        else:
+            self.errors = 0
+            self.interval = min(self.base_interval, self.interval * 2)
+        if not error:
+            self.last_keys = keys
+        return self.interval
+
+    def schedule_next(self, now):
+        """
+        Set next run time one interval from now, with jitter
+        """
+        jitter = self.interval * self.jitter
+        self.next_run = now + self.interval + random.uniform(-jitter, jitter)
+        return self.next_run
+
+    def _summarize(self, result, failed):
+        """
+        Return (error, keys) of a job result. Results of the all chains job
+        are keyed by finder name and summarized together
+        """
+        if failed:
+            return True, None
+        if not result or result.get("skipped"):
+            return False, self.last_keys
+        if "success" in result:
+            return bool(result.get("error")), tuple(result.get("keys", []))
+
+        error = any(r.get("error") for r in result.values())
+        if any(r.get("skipped") for r in result.values()):
+            return error, self.last_keys
+        keys = tuple(
+            (name, tuple(r.get("keys", [])))
+            for name, r in sorted(result.items())
+        )
+        return error, keys
+
+
+class AdaptiveScheduler(object):
+    """
+    Enqueue each chain's job at its own adaptive interval, only during the
+    time window
+
+    A run that comes due while the chain's previous job is unfinished is
+    coalesced into it, and runs are held back while the queue has
+    max_queue_depth or more jobs. Both are counted in the coalesced and
+    backpressure stats
+    """
+
+    def __init__(self, queue, funcs, job_timeout=JOB_TIMEOUT,
+                 max_queue_depth=MAX_QUEUE_DEPTH,
+                 window=(WINDOW_START, WINDOW_END), **schedule_kwargs):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.queue = queue
+        self.window = window
+        self.job_timeout = job_timeout
+        self.max_queue_depth = max_queue_depth
+        self.chains = [ChainSchedule(f, **schedule_kwargs) for f in funcs]
+
+        # Stagger first runs across the min interval
+        now = time.time()
+        if self.chains:
+            stagger = self.chains[0].min_interval / len(self.chains)
+            for i, chain in enumerate(self.chains):
+                chain.next_run = now + i * stagger + random.uniform(
+                    0, stagger * chain.jitter
+                )
+
+    def tick(self, now=None):
+        """
+        Collect finished jobs and enqueue the chains that are due
+        """
+        now = now or time.time()
+        for chain in self.chains:
+            if chain.job_id and not self._collect(chain, now):
+                if now >= chain.next_run:
+                    self._hold_back(chain, "coalesced")
+                continue
+            if now < chain.next_run:
+                continue
+            if not in_range(datetime.datetime.now().time(), *self.window):
+                continue
+            if len(self.queue) >= self.max_queue_depth:
+                self._hold_back(chain, "backpressure")
+                continue
+            job = self.queue.enqueue(
+                chain.func, job_timeout=self.job_timeout
+            )
+            chain.job_id = job.id
+            chain.held_back = False
+            self.logger.info(f"Enqueued {chain.name} job {job.id}")
+
+    def run(self, tick=SCHEDULER_TICK):
+        """
+        Run the scheduler loop forever
+        """
+        while True:
+            self.tick()
+            time.sleep(tick)
+
+    def _hold_back(self, chain, reason):
+        """
+        Count a due run that wasn't enqueued, once per due run
+        """
+        if chain.held_back:
+            return
+        chain.held_back = True
+        incr_stat(reason, chain.name, connection=self.queue.connection)
+        self.logger.warning(f"{chain.name} run held back: {reason}")
+
+    def _collect(self, chain, now):
+        """
+        Record the result of the chain's job if it is done. Return False
+        while it is still queued or running, or has fanned out into
+        sub-jobs whose aggregation is not done
+        """
+        try:
+            job = Job.fetch(chain.job_id, connection=self.queue.connection)
+            status = job.get_status()
+        except NoSuchJobError:
+            status = None
+        if status in (JobStatus.QUEUED, JobStatus.STARTED,
+                      JobStatus.DEFERRED, JobStatus.SCHEDULED):
+            return False
+
+        failed = status != JobStatus.FINISHED
+        result = None if failed else job.return_value()
+        if result and result.get("fan_in"):
+            # Sharded sweep, wait for the job that aggregates its shards
+            chain.job_id = result["fan_in"]
+            return False
+        interval = chain.record(result, failed=failed)
+        chain.schedule_next(now)
+        chain.job_id = None
+        self.logger.info(
+            f"{chain.name} job {'failed' if failed else 'finished'}, next "
+            f"run in {interval} seconds (errors: {chain.errors})"
+        )
+        return True
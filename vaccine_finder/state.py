@@ -0,0 +1,102 @@
+import time
+import logging
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.config import NOTIFY_COOLDOWN
+from vaccine_finder.utils import get_redis_connection
+
+NOTIFIED_KEY = "vaccine_finder:availability:{name}:notified"
+OPEN_KEY = "vaccine_finder:availability:{name}:open"
+LAST_NOTIFIED_KEY = "vaccine_finder:availability:{name}:last_notified"
+
+
+class AvailabilityState(object):
+    """
+    Last known availability of a finder's stores (or query points, pages)
+    kept in Redis, so subscribers are only notified about new openings
+
+    A key is notified once while it stays open. Keys that close are
+    forgotten so they count as new when they open again. Notifications
+    are at most one per cooldown seconds, openings that come up during the
+    cooldown are held back until it ends
+
+    Keys that couldn't be checked in a run keep their last known state
+    (see carry_forward) instead of counting as closed
+    """
+
+    def __init__(self, name, connection=None, cooldown=NOTIFY_COOLDOWN):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.connection = connection or get_redis_connection()
+        self.cooldown = cooldown
+        self.notified_key = NOTIFIED_KEY.format(name=name)
+        self.open_key = OPEN_KEY.format(name=name)
+        self.last_notified_key = LAST_NOTIFIED_KEY.format(name=name)
+
+    def carry_forward(self, keys, unchecked):
+        """
+        Add the keys that couldn't be checked (unchecked) and were open in
+        the last run to the currently open keys, remember and return them
+        """
+        keys = set(keys)
+        unchecked = set(unchecked) - keys
+        try:
+            if unchecked:
+                last_open = {
+                    k.decode()
+                    for k in self.connection.smembers(self.open_key)
+                }
+                keys |= last_open & unchecked
+            pipe = self.connection.pipeline()
+            pipe.delete(self.open_key)
+            if keys:
+                pipe.sadd(self.open_key, *keys)
+            pipe.execute()
+        except RedisError as err:
+            self.logger.warning(f"Availability state unavailable: {err}")
+        return keys
+
+    def openings(self, keys):
+        """
+        Update state with the currently open keys and return the ones to
+        notify about now
+        """
+        keys = set(keys)
+        try:
+            notified = {
+                k.decode() for k in self.connection.smembers(self.notified_key)
+            }
+            closed = notified - keys
+            if closed:
+                self.connection.srem(self.notified_key, *closed)
+            last_notified = float(
+                self.connection.get(self.last_notified_key) or 0
+            )
+        except RedisError as err:
+            self.logger.warning(f"Availability state unavailable: {err}")
+            return keys
+
+        new = keys - notified
+        if not new:
+            return set()
+        wait = last_notified + self.cooldown - time.time()
+        if wait > 0:
+            self.logger.info(
+                f"Holding back {len(new)} new openings, notification "
+                f"cool-down ends in {wait:.0f} seconds"
+            )
+            return set()
+        return new
+
+    def mark_notified(self, keys):
+        """
+        Remember that subscribers were notified about keys
+        """
+        try:
+            pipe = self.connection.pipeline()
+            if keys:
+                pipe.sadd(self.notified_key, *keys)
+            pipe.set(self.last_notified_key, time.time())
+            pipe.execute()
+        except RedisError as err:
+            self.logger.warning(f"Could not save availability state: {err}")
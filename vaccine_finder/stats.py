@@ -0,0 +1,33 @@
+import logging
+
+from redis.exceptions import RedisError
+
+from vaccine_finder.utils import get_redis_connection
+
+STATS_KEY = "vaccine_finder:stats:{stat}"
+
+logger = logging.getLogger(__name__)
+
+
+def incr_stat(stat, label, amount=1, connection=None):
+    """
+    Increment a counter in Redis, e.g. incr_stat("skipped", "riteaid_job")
+    """
+    connection = connection or get_redis_connection()
+    try:
+        connection.hincrby(STATS_KEY.format(stat=stat), label, amount)
+    except RedisError as err:
+        logger.warning(f"Could not count {stat} {label}: {err}")
+
+
+def get_stats(stat, connection=None):
+    """
+    Get all counters of a stat by label
+    """
+    connection = connection or get_redis_connection()
+    return {
+        label.decode(): int(value)
+        for label, value in connection.hgetall(
+            STATS_KEY.format(stat=stat)
+        ).items()
+    }
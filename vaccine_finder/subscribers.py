@@ -0,0 +1,197 @@
+"""
+Subscribers with their own location and radius, and a spatial index that
+matches the locations of openings to the subscribers in range of them
+
+In the input file a subscriber is either just an email, to be notified of
+every opening, or has a location as a zip code or coordinates and an
+optional radius (the deployment's radius by default):
+
+    "subscribers": {
+        "+15550001": "email@example.com",
+        "+15550002": {"email": "...", "zip_code": 19403, "radius": 10},
+        "+15550003": {"latitude": 40.1, "longitude": -75.4}
+    }
+"""
+import math
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from vaccine_finder.config import SUBSCRIBER_CELL_SIZE, SUBSCRIBER_MAX_STORES
+from vaccine_finder.geo import MILES_PER_DEGREE, haversine_matrix
+
+Subscriber = namedtuple(
+    "Subscriber", ["phone_number", "latitude", "longitude", "radius"]
+)
+# Where a finder found appointments. key is the finder's availability key,
+# radius how far from the location the appointments may be
+OpeningLocation = namedtuple(
+    "OpeningLocation", ["key", "label", "latitude", "longitude", "radius"]
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_subscriber(entry):
+    """
+    Split an input file subscriber entry into its email and its location
+    entry, None if it has no location
+    """
+    if not isinstance(entry, dict):
+        return entry, None
+    if any(k in entry for k in ("zip_code", "latitude", "longitude")):
+        return entry.get("email"), entry
+    return entry.get("email"), None
+
+
+def parse_subscribers(entries):
+    """
+    Split the input file's subscribers into emails by phone number and
+    location entries by phone number, for those that have one
+    """
+    emails = {}
+    locations = {}
+    for phone_number, entry in entries.items():
+        emails[phone_number], location = parse_subscriber(entry)
+        if location is not None:
+            locations[phone_number] = location
+    return emails, locations
+
+
+def locate_subscribers(locations, geocoder, default_radius):
+    """
+    Resolve location entries to Subscribers. Subscribers whose location
+    can't be resolved are left out and so notified of every opening
+    """
+    subscribers = []
+    for phone_number, entry in locations.items():
+        try:
+            if "zip_code" in entry:
+                latitude, longitude = geocoder.locate(entry["zip_code"])
+            else:
+                latitude = float(entry["latitude"])
+                longitude = float(entry["longitude"])
+        except (LookupError, ValueError, TypeError) as err:
+            logger.warning(
+                f"Notifying {phone_number} of every opening, location "
+                f"unknown: {err!r}"
+            )
+            continue
+        subscribers.append(Subscriber(
+            phone_number, latitude, longitude,
+            float(entry.get("radius", default_radius)),
+        ))
+    return subscribers
+
+
+class _Cell(object):
+    """
+    Subscribers of one grid cell, in miles from the cell's center
+    """
+
+    def __init__(self, subscribers, latitude, longitude):
+        self.phone_numbers = [s.phone_number for s in subscribers]
+        self.latitude = latitude
+        self.longitude = longitude
+        self.x_scale = MILES_PER_DEGREE * math.cos(math.radians(latitude))
+        self.x, self.y = self.to_xy(
+            np.array([s.latitude for s in subscribers]),
+            np.array([s.longitude for s in subscribers]),
+        )
+        self.radii = np.array([s.radius for s in subscribers])
+
+    def to_xy(self, latitudes, longitudes):
+        return (
+            (longitudes - self.longitude) * self.x_scale,
+            (latitudes - self.latitude) * MILES_PER_DEGREE,
+        )
+
+
+class SubscriberIndex(object):
+    """
+    Located subscribers bucketed into a grid of cells cell_size miles of
+    latitude high and as many degrees wide
+
+    match only computes distances between the subscribers of a cell and the
+    openings that can be in range of any of them, a distance matrix per
+    cell on a projection around its center
+    """
+
+    def __init__(self, subscribers, cell_size=SUBSCRIBER_CELL_SIZE):
+        self.cell_degrees = cell_size / MILES_PER_DEGREE
+        buckets = {}
+        for s in subscribers:
+            key = (
+                math.floor(s.latitude / self.cell_degrees),
+                math.floor(s.longitude / self.cell_degrees),
+            )
+            buckets.setdefault(key, []).append(s)
+        self.cells = [
+            _Cell(
+                b, (lat + 0.5) * self.cell_degrees,
+                (lon + 0.5) * self.cell_degrees,
+            )
+            for (lat, lon), b in buckets.items()
+        ]
+        self.phone_numbers = {s.phone_number for s in subscribers}
+        self.center_latitudes = np.array([c.latitude for c in self.cells])
+        self.center_longitudes = np.array([c.longitude for c in self.cells])
+        # Every subscriber of a cell is within half a diagonal of its
+        # center, so nothing beyond reach of the center is in their range
+        half_diagonal = cell_size * math.sqrt(2) / 2
+        self.reach = np.array([
+            cell.radii.max() + half_diagonal for cell in self.cells
+        ])
+
+    def match(self, locations, limit=SUBSCRIBER_MAX_STORES):
+        """
+        Return the opening locations in range of each subscriber, at most
+        limit of them nearest first, by phone number. Subscribers with no
+        opening in range are left out
+        """
+        if not locations or not self.cells:
+            return {}
+        latitudes = np.array([loc.latitude for loc in locations])
+        longitudes = np.array([loc.longitude for loc in locations])
+        radii = np.array([loc.radius for loc in locations])
+
+        center_distances = haversine_matrix(
+            self.center_latitudes, self.center_longitudes,
+            latitudes, longitudes,
+        )
+        reachable = center_distances <= self.reach[:, None] + radii[None, :]
+
+        matches = {}
+        for c in np.nonzero(reachable.any(axis=1))[0]:
+            cell = self.cells[c]
+            near = np.nonzero(reachable[c])[0]
+            # Squared distances on the cell's local projection, which is
+            # accurate to well within a mile over a subscriber's radius
+            x, y = cell.to_xy(latitudes[near], longitudes[near])
+            distances = (
+                (cell.x[:, None] - x[None, :]) ** 2 +
+                (cell.y[:, None] - y[None, :]) ** 2
+            )
+            in_range = distances <= (
+                cell.radii[:, None] + radii[near][None, :]
+            ) ** 2
+            distances = np.where(in_range, distances, np.inf)
+            rows = np.arange(len(distances))[:, None]
+            if distances.shape[1] > limit:
+                # Only sort each subscriber's limit nearest
+                nearest = np.argpartition(distances, limit - 1, axis=1)
+                nearest = nearest[:, :limit]
+            else:
+                nearest = np.broadcast_to(
+                    np.arange(distances.shape[1]), distances.shape
+                )
+            nearest = nearest[
+                rows, np.argsort(distances[rows, nearest], axis=1)
+            ]
+            for i in np.nonzero(in_range.any(axis=1))[0]:
+                matches[cell.phone_numbers[i]] = [
+                    locations[near[j]] for j in nearest[i]
+                    if in_range[i, j]
+                ]
+        return matches
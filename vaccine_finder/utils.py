@@ -1,24 +1,127 @@
+import atexit
 import json
 import logging
+import os
+import queue
+import random
+import time
+from collections import namedtuple
+from html.parser import HTMLParser
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit
+
 import requests
+from redis import Redis
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
-from vaccine_finder.config import VACCINE_FINDER_LOG_LEVEL
+from vaccine_finder.config import (
+    VACCINE_FINDER_LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE,
+    REDIS_HOST, REDIS_PORT, HTML_PARSER,
+    HTTP_MAX_RETRIES, HTTP_BACKOFF, HTTP_BACKOFF_MAX,
+)
+from vaccine_finder.metrics import incr_metric, observe_metric
+from vaccine_finder.ratelimit import HostRateLimiter, SLOW_DOWN_STATUSES
+from vaccine_finder.breaker import CircuitBreaker
 logger = logging.getLogger(__name__)
 
+PAGE_CHUNK_SIZE = 16 * 1024
+# Failures send_request retries
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+)
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+ElementCount = namedtuple("ElementCount", ["count", "exceeded", "complete"])
+
+# Extra fields of a log record are its attributes not in here
+_RECORD_ATTRS = set(vars(
+    logging.LogRecord("", 0, "", 0, "", None, None)
+)) | {"message", "asctime", "sampled"}
+# Pass extra=SAMPLED to log per store chatter, see SampleFilter
+SAMPLED = {"sampled": True}
+
+_redis_connection = None
+_rate_limiter = None
+_circuit_breakers = {}
+_log_listener = None
+_log_queue_handler = None
+
+
+def endpoint_label(url):
+    """
+    Host and path of a url, the endpoint its request metrics are kept under
+    """
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
 
-def send_request(session, method_name, url, **kwargs):
+def send_request(
+    session, method_name, url, return_response=False,
+    max_retries=HTTP_MAX_RETRIES, **kwargs
+):
     """
     Send HTTP request to url
+
+    Return the json or text content of the response, or the response itself
+    if return_response is True
+
+    Connection errors, timeouts and 429/5xx responses are retried up to
+    max_retries times with jittered exponential backoff. Requests to an
+    endpoint whose circuit is open fail fast with CircuitOpenError
+
+    Records the request's latency, status and response size by endpoint.
+    The latency of a streamed (stream=True) request is the time to its
+    headers
     """
-    http_method = getattr(session, method_name)
-    response = http_method(url, **kwargs)
+    endpoint = endpoint_label(url)
+    labels = {"endpoint": endpoint, "method": method_name}
+    breaker = get_circuit_breaker(endpoint)
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_request()
+        try:
+            response = _send_once(session, method_name, url, labels, **kwargs)
+        except requests.exceptions.RequestException as err:
+            breaker.record_failure()
+            if not isinstance(err, TRANSIENT_ERRORS) or attempt > max_retries:
+                raise
+            error = repr(err)
+        else:
+            if response.status_code not in TRANSIENT_STATUSES:
+                breaker.record_success()
+                break
+            breaker.record_failure()
+            if attempt > max_retries:
+                break
+            response.close()
+            error = f"status {response.status_code}"
+
+        delay = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** (attempt - 1))
+        delay *= 0.5 + random.random()
+        logger.warning(
+            f"Retrying {method_name} {endpoint} in {delay:.1f}s: {error}"
+        )
+        incr_metric("http_retries", labels)
+        time.sleep(delay)
 
     try:
         response.raise_for_status()
     except requests.exceptions.HTTPError:
+        incr_metric("http_errors", dict(labels, error=response.status_code))
         logger.error(f"Bad status code. Caused by:\n{response.text}")
         raise
 
+    if return_response:
+        size = response.headers.get("Content-Length")
+        if size and size.isdigit():
+            incr_metric("http_response_bytes", labels, int(size))
+        return response
+
+    incr_metric("http_response_bytes", labels, len(response.content))
     try:
         content = response.json()
     except json.decoder.JSONDecodeError as e:
@@ -28,15 +131,289 @@ def send_request(session, method_name, url, **kwargs):
     return content
 
 
-def setup_logger(log_level=VACCINE_FINDER_LOG_LEVEL):
+def _send_once(session, method_name, url, labels, **kwargs):
+    """
+    Send one request after waiting for the host's shared rate limit, and
+    slow requests to the host down if it throttles this one
+    """
+    host = urlsplit(url).netloc
+    waited = get_rate_limiter().acquire(host)
+    if waited:
+        observe_metric("rate_limit_wait_seconds", {"host": host}, waited)
+    start = time.monotonic()
+    try:
+        response = getattr(session, method_name)(url, **kwargs)
+    except requests.exceptions.RequestException as err:
+        observe_metric(
+            "http_request_seconds", dict(labels, status="error"),
+            time.monotonic() - start
+        )
+        incr_metric(
+            "http_errors", dict(labels, error=type(err).__name__)
+        )
+        raise
+    observe_metric(
+        "http_request_seconds", dict(labels, status=response.status_code),
+        time.monotonic() - start
+    )
+    if response.status_code in SLOW_DOWN_STATUSES:
+        retry_after = response.headers.get("Retry-After", "")
+        get_rate_limiter().slow_down(
+            host, float(retry_after) if retry_after.isdigit() else None
+        )
+        incr_metric("rate_limit_slowdowns", {"host": host})
+    return response
+
+
+class StartTagCounter(HTMLParser):
+    """
+    Incremental HTML parser that only counts start tags, the same elements
+    BeautifulSoup's findAll returns with the html.parser backend
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.count += 1
+
+
+class LxmlStartTagCounter(object):
+    """
+    StartTagCounter backed by libxml2. It sees the same start tags for
+    documents with explicit html and body tags, but libxml2 adds the html,
+    body and p elements that fragments leave implied
+    """
+
+    class _Target(object):
+        def __init__(self):
+            self.count = 0
+
+        def start(self, tag, attrib):
+            self.count += 1
+
+        def end(self, tag):
+            pass
+
+        def data(self, data):
+            pass
+
+        def close(self):
+            return self.count
+
+    def __init__(self):
+        self._target = self._Target()
+        self._parser = etree.HTMLParser(target=self._target)
+
+    @property
+    def count(self):
+        return self._target.count
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        self._parser.close()
+
+
+HTML_PARSERS = {
+    "html.parser": StartTagCounter,
+    "lxml": LxmlStartTagCounter,
+}
+
+
+def get_element_counter(parser=HTML_PARSER):
+    """
+    Create a start tag counter for the parser backend, the pure Python
+    html.parser or, if it is installed, lxml
+    """
+    if parser not in HTML_PARSERS:
+        raise ValueError(
+            f"Unknown HTML parser {parser}, use one of {list(HTML_PARSERS)}"
+        )
+    if parser == "lxml" and etree is None:
+        raise ValueError("HTML parser lxml is not installed")
+    return HTML_PARSERS[parser]()
+
+
+def count_page_elements(chunks, threshold, parser=HTML_PARSER):
+    """
+    Count the elements of an HTML page, given as an iterable of decoded
+    text chunks, e.g. of a streamed response
+
+    Each chunk is fed to an incremental parser as it comes. Counting, and
+    reading chunks, stops as soon as more than threshold elements were
+    seen, so ElementCount.complete is False and count is a lower bound in
+    that case
+    """
+    counter = get_element_counter(parser)
+    complete = True
+    for chunk in chunks:
+        counter.feed(chunk)
+        if counter.count > threshold:
+            complete = False
+            break
+    if complete:
+        counter.close()
+    return ElementCount(counter.count, counter.count > threshold, complete)
+
+
+class LazyFormat(object):
+    """
+    Log argument that calls func(*args) only when the record is formatted,
+    e.g. logger.debug("Received:\n%s", LazyFormat(pformat, content))
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class SampleFilter(logging.Filter):
+    """
+    Let through a rate fraction of the records logged with extra=SAMPLED,
+    per store chatter. Warnings and errors always pass
+    """
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if not getattr(record, "sampled", False):
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line. Fields passed in extra are
+    included
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (k, v) for k, v in record.__dict__.items()
+            if k not in _RECORD_ATTRS
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting the message to the listener
+    thread. Records stay in process so they needn't be made picklable
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _stop_log_listener():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+def _log_synchronously_after_fork():
+    """
+    The listener thread doesn't survive a fork. Forked children, e.g. rq
+    work horses that leave with os._exit and skip atexit, write records
+    synchronously instead so none are left behind in the queue
+    """
+    global _log_listener, _log_queue_handler
+    if _log_listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_log_queue_handler)
+    for handler in _log_listener.handlers:
+        for filter_ in _log_queue_handler.filters:
+            handler.addFilter(filter_)
+        handler._vaccine_finder = True
+        root.addHandler(handler)
+    _log_listener = None
+    _log_queue_handler = None
+
+
+def setup_logger(
+    log_level=VACCINE_FINDER_LOG_LEVEL, log_format=LOG_FORMAT,
+    sample_rate=LOG_SAMPLE_RATE,
+):
     """
-    Setup logger
+    Setup logger. Safe to call more than once, the logging pipeline is only
+    added to the root logger the first time
+
+    Records are put on a queue and formatted and written by a listener
+    thread, as text or JSON (log_format). Per store chatter is sampled.
+    Forked children log synchronously
     """
+    global _log_listener, _log_queue_handler
     format_ = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     root = logging.getLogger()
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(logging.Formatter(format_))
     root.setLevel(log_level)
-    root.addHandler(consoleHandler)
+    if not any(
+        getattr(h, "_vaccine_finder", False) for h in root.handlers
+    ):
+        consoleHandler = logging.StreamHandler()
+        if log_format == "json":
+            consoleHandler.setFormatter(JsonFormatter())
+        else:
+            consoleHandler.setFormatter(logging.Formatter(format_))
+        log_queue = queue.SimpleQueue()
+        queueHandler = DeferredQueueHandler(log_queue)
+        queueHandler.addFilter(SampleFilter(sample_rate))
+        queueHandler._vaccine_finder = True
+        root.addHandler(queueHandler)
+        _log_queue_handler = queueHandler
+        _log_listener = QueueListener(log_queue, consoleHandler)
+        _log_listener.start()
+        atexit.register(_stop_log_listener)
+        os.register_at_fork(after_in_child=_log_synchronously_after_fork)
     logger = logging.getLogger(__name__)
     return logger
+
+
+def get_redis_connection():
+    """
+    Get the process wide Redis connection. The connection is lazy so this
+    never fails, callers must handle redis.exceptions.RedisError on use
+    """
+    global _redis_connection
+    if _redis_connection is None:
+        _redis_connection = Redis(host=REDIS_HOST, port=REDIS_PORT)
+    return _redis_connection
+
+
+def get_rate_limiter():
+    """
+    Get the process wide rate limiter of upstream hosts
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = HostRateLimiter(get_redis_connection())
+    return _rate_limiter
+
+
+def get_circuit_breaker(endpoint):
+    """
+    Get this process' circuit breaker of an endpoint
+    """
+    breaker = _circuit_breakers.get(endpoint)
+    if breaker is None:
+        breaker = _circuit_breakers.setdefault(
+            endpoint, CircuitBreaker(endpoint)
+        )
+    return breaker
@@ -8,9 +8,15 @@ import requests
 from geopy.geocoders import Nominatim
 
 from vaccine_finder.config import DEFAULT_INPUT_FILE
-from vaccine_finder.utils import setup_logger, send_request
+from vaccine_finder.utils import setup_logger, send_request, LazyFormat
 from vaccine_finder.notify import Notifier
 from vaccine_finder.base import BaseAppointmentFinder
+from vaccine_finder.regions import DEFAULT_REGION
+from vaccine_finder.profiling import FinderProfile
+from vaccine_finder.geo import ZipGeocoder
+from vaccine_finder.walgreens.planner import plan_queries
+from vaccine_finder.subscribers import OpeningLocation
+from vaccine_finder.cache import AvailabilityCache
 
 AVAIL_ENDPOINT = (
     "https://www.walgreens.com/hcschedulersvc/svc/v1/immunizationLocations/availability"
@@ -19,6 +25,7 @@ SCHEDULER_ENDPOINT = (
     "https://www.walgreens.com/findcare/vaccination/covid-19/location-screening"
 )
 STORE_LABEL = "Walgreens"
+MAX_QUERY_RADIUS = 25  # server complains if greater than 25
 
 
 class WalgreensAppointmentFinder(BaseAppointmentFinder):
@@ -27,42 +34,70 @@ class WalgreensAppointmentFinder(BaseAppointmentFinder):
         debug=False,
         input_file=DEFAULT_INPUT_FILE,
         cookie_dict=None,
+        region=DEFAULT_REGION,
     ):
         super().__init__(
             STORE_LABEL, SCHEDULER_ENDPOINT,
-            debug=debug, input_file=input_file, cookie_dict=cookie_dict
+            debug=debug, input_file=input_file, cookie_dict=cookie_dict,
+            region=region,
         )
-        self.geolocator = Nominatim(user_agent=type(self).__name__)
+        # Nominatim is only used for zip codes missing from the offline table
+        self.geocoder = ZipGeocoder(
+            fallback=Nominatim(user_agent=type(self).__name__)
+        )
+        self._plans = {}
+        # Responses by query point and day, shared by all workers
+        self.availability_cache = AvailabilityCache("walgreens")
 
-    def _find(self, zip_codes=None, radius=None):
+    def _find(self, zip_codes=None, radius=None, points_with_appts=None):
         """
         Entrypoint for find script
 
-        Find Walgreens where there are available covid vaccine appointments
+        Find Walgreens where there are available covid vaccine appointments.
+        points_with_appts skips the check, for multi-region sweeps
         """
         self.zip_codes = zip_codes or self.zip_codes
+        self.radius = radius or self.radius
 
         self.logger.info("Starting vaccine finder ...")
 
-        # Send request
-        for zip_code in self.zip_codes:
+        if points_with_appts is None:
+            points_with_appts = self.check_points(
+                self._get_query_plan(self.zip_codes, self.radius)
+            )
+        self.points_with_appts = points_with_appts
+        return len(self.points_with_appts) > 0
+
+    def check_points(self, points):
+        """
+        Send a request for each query point, return the points with
+        appointments
+        """
+        points_with_appts = []
+        for point in points:
             d = datetime.datetime.now().date().isoformat()
-            loc = self.geolocator.geocode(str(zip_code))
             body = {
                 "serviceId": "99",
                 "position": {
-                    "latitude": loc.latitude,
-                    "longitude": loc.longitude
+                    "latitude": point.latitude,
+                    "longitude": point.longitude
                 },
                 "appointmentAvailability": {"startDateTime": d},
-                "radius": 25  # server complains if greater than 25
+                "radius": point.radius
             }
+            key = (
+                f"{point.latitude:.4f},{point.longitude:.4f},"
+                f"{point.radius}:{d}"
+            )
             try:
-                content = send_request(
-                    self.session,
-                    "post",
-                    AVAIL_ENDPOINT,
-                    json=body,
+                content = self.availability_cache.get(
+                    key,
+                    lambda: send_request(
+                        self.session,
+                        "post",
+                        AVAIL_ENDPOINT,
+                        json=body,
+                    ),
                 )
             except requests.exceptions.RequestException as err:
                 self.logger.error(
@@ -70,12 +105,67 @@ class WalgreensAppointmentFinder(BaseAppointmentFinder):
                 )
                 raise
 
-            self.logger.info(f"Received response:\n{pformat(content)}")
+            self.logger.debug(
+                "Received response:\n%s", LazyFormat(pformat, content)
+            )
 
             # Check availability
-            avail = self._check_availability(content, zip_code)
+            if self._check_availability(content, point):
+                points_with_appts.append(point)
 
-        return avail
+        return points_with_appts
+
+    @classmethod
+    def _sweep_shared(cls, finders):
+        """
+        Check the union of the regions' query points once, each region
+        gets the points with appointments among its own
+        """
+        plans = [
+            finder._get_query_plan(finder.zip_codes, finder.radius)
+            for finder in finders
+        ]
+        points = list(dict.fromkeys(p for plan in plans for p in plan))
+        finders[0].logger.info(
+            f"Checking {len(points)} query points for {len(finders)} "
+            f"regions with {sum(len(p) for p in plans)} points in total"
+        )
+        available = set(finders[0].check_points(points))
+        return [
+            {"points_with_appts": [p for p in plan if p in available]}
+            for plan in plans
+        ]
+
+    def _get_query_plan(self, zip_codes, radius):
+        """
+        Get the query points covering radius miles around the zip codes.
+        Plans are cached per zip codes and radius
+        """
+        plan_key = (tuple(zip_codes), radius)
+        if plan_key in self._plans:
+            return self._plans[plan_key]
+
+        centers = []
+        for zip_code in zip_codes:
+            try:
+                centers.append(self.geocoder.locate(zip_code))
+            except LookupError as err:
+                self.logger.error(f"Skipping zip code {zip_code}: {err}")
+
+        plan = plan_queries(centers, radius, MAX_QUERY_RADIUS)
+        # Plan size if each zip code were covered on its own
+        naive = len(centers) * len(
+            plan_queries(centers[:1], radius, MAX_QUERY_RADIUS)
+        )
+        self.logger.info(
+            f"Query plan for {len(zip_codes)} zip codes within radius "
+            f"{radius} miles has {len(plan)} points (per zip code plan: "
+            f"{naive} points)"
+        )
+        # Don't cache plans missing zip codes that failed to geocode
+        if len(centers) == len(zip_codes):
+            self._plans[plan_key] = plan
+        return plan
 
     def _notification_message(self):
         """
@@ -84,7 +174,30 @@ class WalgreensAppointmentFinder(BaseAppointmentFinder):
         """
         return f"Stores in zip codes {pformat(self.zip_codes)}"
 
-    def _check_availability(self, content, zip_code):
+    def _opening_locations(self):
+        """
+        Query points with appointments, somewhere within their radius
+        """
+        return [
+            OpeningLocation(
+                f"{point.latitude:.4f},{point.longitude:.4f}",
+                f"Stores within {point.radius} miles of "
+                f"({point.latitude:.4f}, {point.longitude:.4f})",
+                point.latitude, point.longitude, point.radius,
+            )
+            for point in self.points_with_appts
+        ]
+
+    def _availability_keys(self):
+        """
+        Query points with appointments
+        """
+        return {
+            f"{point.latitude:.4f},{point.longitude:.4f}"
+            for point in self.points_with_appts
+        }
+
+    def _check_availability(self, content, point):
         """
         Check if there are any available appointments
         """
@@ -95,16 +208,19 @@ class WalgreensAppointmentFinder(BaseAppointmentFinder):
         if success:
             self.logger.info(
                 f"✅ Vaccine appointments available at "
-                f"{self.store_label} within zip code {zip_code}"
+                f"{self.store_label} within {point.radius} miles of "
+                f"({point.latitude:.4f}, {point.longitude:.4f})"
             )
         else:
             self.logger.info(
                 f"❌ Vaccine appointments not available at "
-                f"{self.store_label} within zip code {zip_code}"
+                f"{self.store_label} within {point.radius} miles of "
+                f"({point.latitude:.4f}, {point.longitude:.4f})"
             )
         return success
 
 
 if __name__ == "__main__":
     f = WalgreensAppointmentFinder(debug=True)
-    success = f.find(notify=False)
+    with FinderProfile(type(f).__name__):
+        success = f.find(notify=False)
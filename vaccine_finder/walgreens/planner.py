@@ -0,0 +1,230 @@
+import math
+from collections import namedtuple
+
+from vaccine_finder.geo import LocalProjection
+
+QueryPoint = namedtuple("QueryPoint", ["latitude", "longitude", "radius"])
+
+# Sample spacing as a fraction of the query radius. Finer sampling wastes
+# less of each query circle on the coverage safety margin but costs more
+# planning time
+SAMPLE_FRACTION = 0.1
+
+
+def plan_queries(centers, radius, max_query_radius):
+    """
+    Plan a small set of query points whose circles of radius at most
+    max_query_radius cover every circle of the given radius around centers
+
+    centers is a list of (latitude, longitude). When radius fits in a single
+    query the plan is just the distinct centers. Otherwise the area is
+    sampled on a grid and query points are picked greedily from a hexagonal
+    covering lattice (plus the centers themselves) until every sample is
+    covered, then points whose samples are all covered by others are
+    dropped. Rings of points around each center often cover a circle with
+    fewer points than the lattice, the smaller of the two plans is used
+    """
+    centers = sorted(set((round(lat, 5), round(lon, 5))
+                         for lat, lon in centers))
+    if not centers:
+        return []
+    if radius <= max_query_radius:
+        return [QueryPoint(lat, lon, radius) for lat, lon in centers]
+
+    projection = LocalProjection(
+        sum(lat for lat, _ in centers) / len(centers),
+        sum(lon for _, lon in centers) / len(centers),
+    )
+    xy_centers = [projection.to_xy(lat, lon) for lat, lon in centers]
+
+    # Every point of the area is within `slack` of some sample, so covering
+    # the samples with circles shrunk by `slack` covers the whole area
+    step = max_query_radius * SAMPLE_FRACTION
+    slack = step / math.sqrt(2)
+    cover_radius = max_query_radius - slack
+    samples = _grid_samples(xy_centers, radius + slack, step)
+
+    candidates = list(xy_centers)
+    candidates.extend(_hex_lattice(xy_centers, radius + cover_radius,
+                                   cover_radius))
+    coverage = [
+        _covered_samples(x, y, cover_radius, step, samples)
+        for x, y in candidates
+    ]
+
+    lattice = list(range(len(candidates)))
+    plans = [_prune(_greedy_cover(lattice, coverage, samples), coverage)]
+
+    # Rings of query points around each center
+    for cx, cy in xy_centers:
+        for x, y in _rings(radius + slack, cover_radius):
+            candidates.append((cx + x, cy + y))
+            coverage.append(_covered_samples(
+                cx + x, cy + y, cover_radius, step, samples
+            ))
+    rings = list(range(len(lattice), len(candidates)))
+    if set().union(*(coverage[i] for i in rings)) >= samples:
+        plans.append(_prune(rings, coverage))
+
+    return [
+        QueryPoint(*projection.to_latlon(*candidates[i]), max_query_radius)
+        for i in min(plans, key=len)
+    ]
+
+
+def _greedy_cover(candidates, coverage, samples):
+    """
+    Greedy set cover of samples by the candidates' coverage
+    """
+    uncovered = set(samples)
+    chosen = []
+    while uncovered:
+        best = max(candidates, key=lambda i: len(coverage[i] & uncovered))
+        if not coverage[best] & uncovered:
+            break
+        chosen.append(best)
+        uncovered -= coverage[best]
+    return chosen
+
+
+def _prune(chosen, coverage):
+    """
+    Drop points made redundant by the other chosen points, latest first
+    """
+    chosen = list(chosen)
+    for i in list(reversed(chosen)):
+        others = set().union(*(coverage[j] for j in chosen if j != i))
+        if coverage[i] <= others:
+            chosen.remove(i)
+    return chosen
+
+
+def _rings(radius, cover_radius, max_ring_size=64):
+    """
+    Offsets from a center of points whose circles of cover_radius cover
+    the circle of radius around it - the center, then rings outwards. Each
+    ring has the number of points covering the most area per point
+    """
+    points = [(0.0, 0.0)]
+    inner = cover_radius
+    while inner < radius:
+        best = None
+        for n in range(3, max_ring_size + 1):
+            ring = _ring(n, inner, radius, cover_radius)
+            if ring is None:
+                continue
+            outer, _ = ring
+            if outer >= radius:
+                best = (n,) + ring
+                break
+            if best is None or (
+                (outer ** 2 - inner ** 2) / n
+                > (best[1] ** 2 - inner ** 2) / best[0]
+            ):
+                best = (n,) + ring
+        if best is None:
+            break
+        n, outer, distance = best
+        points.extend(
+            (distance * math.cos(2 * math.pi * k / n),
+             distance * math.sin(2 * math.pi * k / n))
+            for k in range(n)
+        )
+        inner = outer
+    return points
+
+
+def _ring(n, inner, radius, cover_radius):
+    """
+    The farthest outer radius, up to radius, of the annulus from inner a
+    ring of n points covers, and the ring's distance from the center. None
+    if n points can't cover past inner
+    """
+    def distances(r):
+        # Range of ring distances at which a point's circle reaches the
+        # circle of radius r halfway to the next point
+        half = math.pi / n
+        reach = cover_radius ** 2 - (r * math.sin(half)) ** 2
+        if reach < 0:
+            return None
+        return (r * math.cos(half) - math.sqrt(reach),
+                r * math.cos(half) + math.sqrt(reach))
+
+    def distance(outer):
+        low, high = distances(inner), distances(outer)
+        if low is None or high is None:
+            return None
+        start, end = max(low[0], high[0]), min(low[1], high[1])
+        return start if start <= end else None
+
+    if distance(radius) is not None:
+        return radius, distance(radius)
+    if distance(inner) is None:
+        return None
+    # Bisect for the farthest coverable outer radius
+    low, high = inner, radius
+    for _ in range(50):
+        middle = (low + high) / 2
+        if distance(middle) is None:
+            high = middle
+        else:
+            low = middle
+    if low <= inner:
+        return None
+    return low, distance(low)
+
+
+def _grid_samples(xy_centers, radius, step):
+    """
+    Grid cells (i, j) whose point (i * step, j * step) lies within radius
+    of any center
+    """
+    samples = set()
+    n = int(math.ceil(radius / step))
+    for cx, cy in xy_centers:
+        ci, cj = int(round(cx / step)), int(round(cy / step))
+        for i in range(ci - n, ci + n + 1):
+            for j in range(cj - n, cj + n + 1):
+                if math.hypot(i * step - cx, j * step - cy) <= radius:
+                    samples.add((i, j))
+    return samples
+
+
+def _hex_lattice(xy_centers, radius, cover_radius):
+    """
+    Points of the hexagonal lattice that covers the plane with circles of
+    cover_radius, kept when within radius of any center
+    """
+    dx = cover_radius * math.sqrt(3)
+    dy = cover_radius * 1.5
+    xs = [x for x, _ in xy_centers]
+    ys = [y for _, y in xy_centers]
+    points = []
+    row_min = int(math.floor((min(ys) - radius) / dy))
+    row_max = int(math.ceil((max(ys) + radius) / dy))
+    for row in range(row_min, row_max + 1):
+        y = row * dy
+        offset = dx / 2 if row % 2 else 0
+        col_min = int(math.floor((min(xs) - radius - offset) / dx))
+        col_max = int(math.ceil((max(xs) + radius - offset) / dx))
+        for col in range(col_min, col_max + 1):
+            x = col * dx + offset
+            if any(math.hypot(x - cx, y - cy) <= radius
+                   for cx, cy in xy_centers):
+                points.append((x, y))
+    return points
+
+
+def _covered_samples(x, y, radius, step, samples):
+    """
+    Samples within radius of (x, y)
+    """
+    covered = set()
+    n = int(math.ceil(radius / step))
+    ci, cj = int(round(x / step)), int(round(y / step))
+    for i in range(ci - n, ci + n + 1):
+        for j in range(cj - n, cj + n + 1):
+            if ((i, j) in samples and
+                    math.hypot(i * step - x, j * step - y) <= radius):
+                covered.add((i, j))
+    return covered
@@ -4,12 +4,14 @@ from pprint import pprint, pformat
 import logging
 
 import requests
-from bs4 import BeautifulSoup
 
 from vaccine_finder.config import DEFAULT_INPUT_FILE
-from vaccine_finder.utils import setup_logger, send_request
+from vaccine_finder.utils import setup_logger
 from vaccine_finder.notify import Notifier
 from vaccine_finder.base import BaseAppointmentFinder
+from vaccine_finder.regions import DEFAULT_REGION
+from vaccine_finder.profiling import FinderProfile
+from vaccine_finder.fingerprint import PageFingerprintCache
 
 AVAIL_ENDPOINT = (
     "https://www.wegmans.com/covid-vaccine-registration/"
@@ -27,28 +29,37 @@ class WegmansAppointmentFinder(BaseAppointmentFinder):
         debug=False,
         input_file=DEFAULT_INPUT_FILE,
         cookie_dict=None,
+        region=DEFAULT_REGION,
     ):
         super().__init__(
             STORE_LABEL, SCHEDULER_ENDPOINT,
-            debug=debug, input_file=input_file, cookie_dict=cookie_dict
+            debug=debug, input_file=input_file, cookie_dict=cookie_dict,
+            region=region,
         )
+        self.page_cache = PageFingerprintCache()
 
-    def _find(self, zip_codes=None, radius=None):
+    def _find(self, zip_codes=None, radius=None, page_result=None):
         """
         Entrypoint for find script
 
-        Find Wegmans where there are available covid vaccine appointments
+        Find Wegmans where there are available covid vaccine appointments.
+        page_result, the availability found by another region's check,
+        skips checking the page
         """
         self.zip_codes = zip_codes or self.zip_codes
+        if page_result is not None:
+            return page_result
 
         self.logger.info("Starting vaccine finder ...")
 
-        # Send request
+        # Skipped by the server (304) if the page didn't change since the
+        # last check, only read up to TOTAL_PAGE_ELEMENTS elements otherwise
         try:
-            content = send_request(
+            page = self.page_cache.check(
                 self.session,
-                "get",
                 AVAIL_ENDPOINT,
+                TOTAL_PAGE_ELEMENTS,
+                force=self.debug,
                 headers={"User-Agent": "Vaccine-Finder"},
             )
         except requests.exceptions.RequestException as err:
@@ -57,12 +68,15 @@ class WegmansAppointmentFinder(BaseAppointmentFinder):
             )
             raise
 
-        self.logger.debug(f"Received response:\n{pformat(content)}")
+        return self._check_availability(page)
 
-        # Check availability
-        avail = self._check_availability(content)
-
-        return avail
+    @classmethod
+    def _sweep_shared(cls, finders):
+        """
+        The page is the same in every region, check it once
+        """
+        avail = finders[0]._find()
+        return [{"page_result": avail} for finder in finders]
 
     def _notification_message(self):
         """
@@ -71,16 +85,27 @@ class WegmansAppointmentFinder(BaseAppointmentFinder):
         """
         return "There MIGHT be appointments! Wegmans webpage finally changed!"
 
-    def _check_availability(self, content):
+    def _availability_keys(self):
         """
-        Check if there are any available appointments
+        The page is the only thing that can open up. Its content changes
+        without it closing, so it's keyed by a constant
+        """
+        return {"page"}
+
+    def _check_availability(self, page):
+        """
+        Check if there are any available appointments, if the page has more
+        than TOTAL_PAGE_ELEMENTS elements
         """
         if self.debug:
             return True
 
-        soup = BeautifulSoup(content, 'html.parser')
-        page_elements = len([t for t in soup.findAll()])
-        success = page_elements > TOTAL_PAGE_ELEMENTS
+        if page.elements is not None:
+            self.logger.debug(
+                f"Counted {page.elements.count} page elements "
+                f"(complete: {page.elements.complete})"
+            )
+        success = page.result
 
         if success:
             self.logger.info(
@@ -97,4 +122,5 @@ class WegmansAppointmentFinder(BaseAppointmentFinder):
 
 if __name__ == "__main__":
     f = WegmansAppointmentFinder(debug=True)
-    success = f.find(notify=False)
+    with FinderProfile(type(f).__name__):
+        success = f.find(notify=False)